@@ -0,0 +1,56 @@
+"""
+Time how long every output format takes to encode a render of a PSD, and how big the files get.
+
+    python bench/bench_encoders.py illustration.psd [--repeat 3]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from app import App
+from models import OutputFormat
+import utils
+
+# Name and settings of every format measured
+PRESETS:List[Tuple[str, Dict]] = [
+    ('png level 0', {'format': 'png', 'compressLevel': 0}),
+    ('png level 1', {'format': 'png', 'compressLevel': 1}),
+    ('png level 6 (default)', {'format': 'png', 'compressLevel': 6}),
+    ('png level 9', {'format': 'png', 'compressLevel': 9}),
+    ('png level 9 optimize', {'format': 'png', 'compressLevel': 9, 'optimize': True}),
+    ('webp lossless', {'format': 'webp', 'lossless': True, 'quality': 80}),
+    ('webp lossy q90', {'format': 'webp', 'lossless': False, 'quality': 90}),
+    ('jpeg q90 (flattened)', {'format': 'jpeg', 'quality': 90}),
+]
+
+def main(argv:List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Encode time and size of every output format')
+    parser.add_argument('psd', help='The PSD file to render')
+    parser.add_argument('--repeat', type=int, default=3, help='Times every format is encoded, the best one counts')
+    args = parser.parse_args(argv)
+
+    app = App()
+    app.loadPSD(args.psd)
+    image = app.renderPSD()
+    print('{0}: {1}x{2}'.format(args.psd, image.width, image.height))
+    print('{0:<24} {1:>10} {2:>12}'.format('format', 'seconds', 'KiB'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, settings in PRESETS:
+            outputFormat = OutputFormat.from_dict(settings)
+            fname = os.path.join(tmpdir, 'out' + outputFormat.extension())
+            best = None
+            for _ in range(max(args.repeat, 1)):
+                start = time.perf_counter()
+                utils.saveImage(image, fname, outputFormat)
+                ellapsed = time.perf_counter() - start
+                best = ellapsed if best is None else min(best, ellapsed)
+            print('{0:<24} {1:>10.3f} {2:>12.1f}'.format(name, best, os.path.getsize(fname) / 1024))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,219 @@
+"""
+Time the main stages of the application on a corpus of synthetic PSD files and write the
+results as JSON, to compare them between commits:
+
+    python bench/bench_suite.py --output before.json
+    python bench/bench_suite.py --output after.json
+    python bench/bench_suite.py --compare before.json after.json
+
+The corpus is generated with make_psd.py on the first run and kept in bench/corpus.
+Every stage runs --repeat times and the best, median and mean times are recorded:
+
+* load_cold: App.loadPSD of a file with no layer index
+* load_indexed: App.loadPSD of a file opened before
+* hierarchy: App.layerHierarchy walking the PSD
+* apply: applyVariation and applyModifiers for every image of the export
+* render_first: the first full size renderPSD, with empty layer caches
+* render_all: renderPSD of every image of the export, after the first
+* export: planExport and runExport of everything into an empty folder
+
+The render cache is disabled, so the renders are always composited.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import contextlib
+import statistics
+import subprocess
+import tempfile
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from app import App, LAYER_INDEX_DIRNAME
+from psdindex import PSDIndex
+import exporter
+import utils
+import make_psd
+
+RESULTS_VERSION = 1
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# Name, canvas size, layers, group depth and clip layers of every synthetic file
+PRESETS = {
+    'small': ((1024, 768), 20, 2, 2),
+    'medium': ((2048, 1536), 60, 3, 6),
+    'large': ((4000, 3000), 150, 4, 12),
+}
+
+def corpusFile(name:str, seed:int) -> str:
+    """
+    Returns the path of a synthetic file, generated when missing
+    """
+    size, layers, depth, clips = PRESETS[name]
+    fpath = os.path.join(CORPUS_DIR, '{0}-{1}.psd'.format(name, seed))
+    confPath = os.path.splitext(fpath)[0] + '.json'
+    if not os.path.isfile(fpath) or not os.path.isfile(confPath):
+        print('Generating {0}...'.format(fpath))
+        config = make_psd.generate(fpath, size, layers, depth, clips, seed)
+        with open(confPath, 'wt') as fp:
+            json.dump(config, fp, indent=1)
+    return fpath
+
+def newApp(confPath:str, workers:int) -> App:
+    app = App()
+    app.loadVariationConfig(confPath)
+    app.exportSettings.renderCacheMB = 0
+    app.exportSettings.incremental = False
+    if workers is not None:
+        app.exportSettings.jobs = workers
+    return app
+
+def dropIndex(fpath:str):
+    index = PSDIndex(os.path.join(utils.getBasedir(), LAYER_INDEX_DIRNAME), fpath)
+    if os.path.isfile(index.path):
+        os.remove(index.path)
+
+def timeStage(repeat:int, setup:Callable[[], object], run:Callable[[object], None]) -> Dict:
+    """
+    Time run(setup()) repeat times, only run is measured
+    """
+    runs = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        runs.append(time.perf_counter() - start)
+    return {'best': min(runs), 'median': statistics.median(runs), 'mean': statistics.mean(runs), 'runs': runs}
+
+def benchFile(fpath:str, repeat:int, workers:int) -> Dict[str, Dict]:
+    confPath = os.path.splitext(fpath)[0] + '.json'
+    results = {}
+
+    def loaded() -> App:
+        app = newApp(confPath, workers)
+        app.loadPSD(fpath)
+        return app
+
+    def cold() -> App:
+        dropIndex(fpath)
+        return newApp(confPath, workers)
+    results['load_cold'] = timeStage(repeat, cold, lambda app: app.loadPSD(fpath))
+    results['load_indexed'] = timeStage(repeat, lambda: newApp(confPath, workers), lambda app: app.loadPSD(fpath))
+    results['hierarchy'] = timeStage(repeat, loaded, lambda app: app.layerHierarchy())
+
+    def planned():
+        app = loaded()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = exporter.planExport(app, tmpdir)
+        return app, jobs
+    def applyAll(state):
+        app, jobs = state
+        for job in jobs:
+            app.applyVariation(job.variation, True)
+            app.applyModifiers(job.modifiers, job.combination.bitflags, True)
+    results['apply'] = timeStage(repeat, planned, applyAll)
+
+    def renderFirst(state):
+        app, jobs = state
+        exporter.renderJob(app, jobs[0])
+    results['render_first'] = timeStage(repeat, planned, renderFirst)
+
+    def rendered():
+        app, jobs = planned()
+        exporter.renderJob(app, jobs[0])
+        return app, jobs
+    def renderAll(state):
+        app, jobs = state
+        for job in jobs[1:]:
+            exporter.renderJob(app, job)
+    results['render_all'] = timeStage(repeat, rendered, renderAll)
+
+    def exportAll(app:App):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            jobs = exporter.planExport(app, tmpdir)
+            exporter.runExport(app, jobs, app.exportSettings.jobs)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    results['export'] = timeStage(repeat, loaded, exportAll)
+    return results
+
+def gitCommit() -> str:
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(beforePath:str, afterPath:str) -> int:
+    """
+    Print the best time of every stage in both result files and the speedup
+    """
+    with open(beforePath, 'rt') as fp:
+        before = json.load(fp)
+    with open(afterPath, 'rt') as fp:
+        after = json.load(fp)
+    print('{0:<28} {1:>10} {2:>10} {3:>9}'.format('file/stage', 'before', 'after', 'speedup'))
+    for name, stages in after['results'].items():
+        for stage, timing in stages.items():
+            old = before['results'].get(name, {}).get(stage)
+            if old is None:
+                print('{0:<28} {1:>10} {2:>10.3f}'.format(name + '/' + stage, '-', timing['best']))
+                continue
+            speedup = old['best'] / timing['best'] if timing['best'] > 0 else float('inf')
+            print('{0:<28} {1:>10.3f} {2:>10.3f} {3:>8.2f}x'.format(name + '/' + stage, old['best'], timing['best'], speedup))
+    return 0
+
+def main(argv:List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark loading, variations, rendering and export on synthetic PSD files')
+    parser.add_argument('--preset', action='append', choices=sorted(PRESETS.keys()),
+        help='Synthetic files to run on, can be repeated (small and medium by default)')
+    parser.add_argument('--psd', action='append', default=[],
+        help='Also run on this PSD file, with the variations of the .json file next to it')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic files')
+    parser.add_argument('--repeat', type=int, default=3, help='Times every stage runs')
+    parser.add_argument('--jobs', type=int, default=None, help='Export processes, the config value by default')
+    parser.add_argument('--output', default=None, help='The JSON file to write the results to, standard output by default')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two result files and exit')
+    args = parser.parse_args(argv)
+    if args.compare is not None:
+        return compare(*args.compare)
+
+    report = {
+        'version': RESULTS_VERSION,
+        'commit': gitCommit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'files': {},
+        'results': {},
+    }
+    # The messages of the export go to stderr, stdout only gets the results
+    with contextlib.redirect_stdout(sys.stderr):
+        files = [(name, corpusFile(name, args.seed)) for name in (args.preset or ['small', 'medium'])]
+        files += [(os.path.splitext(os.path.basename(f))[0], f) for f in args.psd]
+        for name, fpath in files:
+            print('Running {0}...'.format(fpath))
+            report['files'][name] = {'path': fpath, 'bytes': os.path.getsize(fpath)}
+            if name in PRESETS:
+                size, layers, depth, clips = PRESETS[name]
+                report['files'][name].update({'size': list(size), 'layers': layers, 'depth': depth, 'clips': clips, 'seed': args.seed})
+            report['results'][name] = benchFile(fpath, max(args.repeat, 1), args.jobs)
+    text = json.dumps(report, indent=1)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'wt') as fp:
+            fp.write(text)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
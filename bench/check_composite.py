@@ -0,0 +1,138 @@
+"""
+Check the compositor of the application against psd-tools on small documents built for
+the cases it has to get right: clipping groups over faded layers and groups, and faded
+pass-through groups whose layers blend with the ones below.
+
+    python bench/check_composite.py
+    python bench/check_composite.py --psd my.psd
+
+Prints the largest difference of every document and exits with 1 when one is above the
+tolerance. The color of fully transparent pixels doesn't count.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer, Group
+from psd_tools.constants import BlendMode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from compositor import Compositor
+
+# Levels the compositor may be off by, it rounds to 8 bits between the steps
+TOLERANCE = 2
+SIZE = (48, 40)
+
+def solid(color, size=SIZE) -> Image.Image:
+    return Image.new('RGBA', size, color)
+
+def newDocument() -> PSDImage:
+    psd = PSDImage.new('RGBA', SIZE)
+    PixelLayer.frompil(solid((90, 180, 230, 255)), psd, 'Background')
+    return psd
+
+def clipOverFadedLayer() -> PSDImage:
+    psd = newDocument()
+    base = PixelLayer.frompil(solid((255, 0, 0, 255), (24, 20)), psd, 'base', top=6, left=8)
+    base.opacity = 128
+    clip = PixelLayer.frompil(solid((0, 0, 255, 128)), psd, 'clip')
+    clip.clipping = True
+    return psd
+
+def clipOverFadedGroup() -> PSDImage:
+    psd = newDocument()
+    group = Group.new(psd, 'group')
+    group.blend_mode = BlendMode.NORMAL
+    group.opacity = 128
+    PixelLayer.frompil(solid((200, 60, 30, 255), (24, 20)), group, 'inner', top=6, left=8)
+    clip = PixelLayer.frompil(solid((20, 90, 240, 200)), psd, 'clip')
+    clip.blend_mode = BlendMode.SOFT_LIGHT
+    clip.clipping = True
+    return psd
+
+def fadedClip() -> PSDImage:
+    psd = newDocument()
+    base = PixelLayer.frompil(solid((250, 200, 30, 220), (24, 20)), psd, 'base', top=6, left=8)
+    base.blend_mode = BlendMode.MULTIPLY
+    clip = PixelLayer.frompil(solid((20, 90, 240, 255)), psd, 'clip')
+    clip.opacity = 100
+    clip.clipping = True
+    return psd
+
+def fadedPassThrough() -> PSDImage:
+    psd = newDocument()
+    group = Group.new(psd, 'group')
+    group.blend_mode = BlendMode.PASS_THROUGH
+    group.opacity = 128
+    layer = PixelLayer.frompil(solid((250, 60, 30, 255), (24, 20)), group, 'multiply', top=6, left=8)
+    layer.blend_mode = BlendMode.MULTIPLY
+    PixelLayer.frompil(solid((0, 0, 0, 160), (10, 10)), group, 'normal', top=12, left=14)
+    return psd
+
+def nestedPassThrough() -> PSDImage:
+    psd = newDocument()
+    outer = Group.new(psd, 'outer')
+    outer.blend_mode = BlendMode.PASS_THROUGH
+    outer.opacity = 200
+    inner = Group.new(outer, 'inner')
+    inner.blend_mode = BlendMode.PASS_THROUGH
+    inner.opacity = 90
+    layer = PixelLayer.frompil(solid((30, 250, 120, 230), (30, 24)), inner, 'screen', top=4, left=4)
+    layer.blend_mode = BlendMode.SCREEN
+    base = PixelLayer.frompil(solid((240, 40, 200, 255), (20, 20)), outer, 'base', top=14, left=20)
+    base.opacity = 150
+    clip = PixelLayer.frompil(solid((0, 0, 0, 180)), outer, 'clip')
+    clip.blend_mode = BlendMode.OVERLAY
+    clip.clipping = True
+    return psd
+
+CASES:Dict[str, Callable[[], PSDImage]] = {
+    'clip over faded layer': clipOverFadedLayer,
+    'clip over faded group': clipOverFadedGroup,
+    'faded clip': fadedClip,
+    'faded pass-through': fadedPassThrough,
+    'nested pass-through': nestedPassThrough,
+}
+
+def difference(psd:PSDImage) -> int:
+    """
+    Largest difference of a channel between psd-tools and the compositor
+    """
+    expected = np.asarray(psd.composite(force=True, ignore_preview=True).convert('RGBA'), dtype=np.int32)
+    actual = np.asarray(Compositor(psd).composite(), dtype=np.int32)
+    diff = np.abs(expected - actual)
+    transparent = (expected[..., 3] == 0) & (actual[..., 3] == 0)
+    diff[transparent] = 0
+    return int(diff.max())
+
+def main(argv:List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Check the compositor against psd-tools')
+    parser.add_argument('--psd', action='append', default=[], help='Check this file too')
+    args = parser.parse_args(argv)
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        documents = []
+        for name, build in CASES.items():
+            # Saved and opened again, like the files the application gets
+            fpath = os.path.join(tmpdir, name.replace(' ', '_') + '.psd')
+            build().save(fpath)
+            documents.append((name, fpath))
+        documents.extend((os.path.basename(p), p) for p in args.psd)
+        for name, fpath in documents:
+            psd = PSDImage.open(fpath)
+            if not Compositor.isSupported(psd):
+                print('{0}: left to psd-tools'.format(name))
+                continue
+            diff = difference(psd)
+            ok = diff <= TOLERANCE
+            failed += 0 if ok else 1
+            print('{0}: max difference {1} {2}'.format(name, diff, 'ok' if ok else 'FAILED'))
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
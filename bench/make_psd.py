@@ -0,0 +1,114 @@
+"""
+Build a synthetic PSD file and a variations config that matches its layers, to benchmark
+the application on documents of a known shape.
+
+    python bench/make_psd.py corpus/medium.psd --size 2048x1536 --layers 60 --depth 3 --clips 6
+
+Writes corpus/medium.psd and corpus/medium.json. The layers are spread over nested groups
+(group_<depth>_<n>), every layer (layer_<n>) is a semi-transparent gradient in a random
+rectangle with a normal, multiply or screen blend mode, and clip layers (clip_<n>) are
+stacked on random layers. The same seed always gives the same file.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer, Group
+from psd_tools.constants import BlendMode
+
+# Groups at the top level, each one holds a chain of depth nested groups
+TOP_GROUPS = 3
+BLEND_MODES = [BlendMode.NORMAL, BlendMode.NORMAL, BlendMode.MULTIPLY, BlendMode.SCREEN]
+
+def gradient(width:int, height:int, rng:random.Random) -> Image.Image:
+    color = np.array([rng.randint(0, 255) for _ in range(3)], dtype=np.float32)
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+    arr = np.empty((height, width, 4), dtype=np.float32)
+    arr[..., :3] = color * (0.4 + 0.6 * x * (1.0 - y))
+    arr[..., 3] = 255.0 * (0.25 + 0.75 * y[..., 0])
+    return Image.fromarray(arr.astype(np.uint8), 'RGBA')
+
+def randomRect(size:Tuple[int, int], rng:random.Random) -> Tuple[int, int, int, int]:
+    width = rng.randint(max(size[0] // 8, 1), max(size[0] // 2, 1))
+    height = rng.randint(max(size[1] // 8, 1), max(size[1] // 2, 1))
+    return rng.randint(0, size[0] - width), rng.randint(0, size[1] - height), width, height
+
+def generate(fpath:str, size:Tuple[int, int], layers:int, depth:int, clips:int, seed:int = 1) -> Dict:
+    """
+    Write the PSD file and return the variations config for it
+    """
+    rng = random.Random(seed)
+    psd = PSDImage.new('RGBA', size)
+    PixelLayer.frompil(Image.new('RGBA', size, (240, 240, 240, 255)), psd, 'Background')
+    # A chain of nested groups under every top level group, the layers go to any of them
+    containers = []
+    topGroups = []
+    for g in range(TOP_GROUPS if depth > 0 else 0):
+        parent = psd
+        for d in range(depth):
+            parent = Group.new(parent, 'group_{0}_{1}'.format(d, g))
+            containers.append(parent)
+        topGroups.append('group_0_{0}'.format(g))
+    if len(containers) == 0:
+        containers.append(psd)
+    clipped = set(rng.sample(range(layers), min(clips, layers)))
+    clipCount = 0
+    for i in range(layers):
+        parent = rng.choice(containers)
+        left, top, width, height = randomRect(size, rng)
+        layer = PixelLayer.frompil(gradient(width, height, rng), parent, 'layer_{0}'.format(i), top=top, left=left)
+        layer.blend_mode = rng.choice(BLEND_MODES)
+        if i in clipped:
+            clip = PixelLayer.frompil(gradient(width, height, rng), parent, 'clip_{0}'.format(clipCount), top=top, left=left)
+            clip.clipping = True
+            clipCount += 1
+    os.makedirs(os.path.dirname(os.path.abspath(fpath)), exist_ok=True)
+    psd.save(fpath)
+    return variationConfig(layers, topGroups)
+
+def variationConfig(layers:int, topGroups:List[str]) -> Dict:
+    """
+    Variations that show everything, drop every top level group in turn and hide half of the
+    layers, each with a few modifiers toggling single layers
+    """
+    modifiers = []
+    for i in range(min(4, layers)):
+        modifiers.append({'id': i + 1, 'name': 'hide_layer_{0}'.format(i), 'suffix': '_h{0}'.format(i),
+            'inclusions': [], 'exclusions': ['regex:^layer_{0}$'.format(i)]})
+    modIds = [m['id'] for m in modifiers]
+    variations = [{'id': 1, 'name': 'all', 'suffix': '_all', 'inclusions': ['glob:*'], 'exclusions': [],
+        'subfolder': '', 'modifiers': modIds[:3], 'combinations': []}]
+    for g in topGroups:
+        variations.append({'id': len(variations) + 1, 'name': 'no_' + g, 'suffix': '_no_' + g,
+            'inclusions': ['glob:*'], 'exclusions': ['glob:' + g], 'subfolder': '', 'modifiers': modIds[:2], 'combinations': []})
+    variations.append({'id': len(variations) + 1, 'name': 'even', 'suffix': '_even', 'inclusions': ['glob:*'],
+        'exclusions': ['regex:^layer_[0-9]*[13579]$'], 'subfolder': '', 'modifiers': modIds, 'combinations': []})
+    return {'variations': variations, 'modifiers': modifiers}
+
+def parseSize(text:str) -> Tuple[int, int]:
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def main(argv:List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Build a synthetic PSD file and its variations config')
+    parser.add_argument('psd', help='The PSD file to write, the config is written next to it with a .json extension')
+    parser.add_argument('--size', type=parseSize, default=(2048, 1536), help='Canvas size, WIDTHxHEIGHT')
+    parser.add_argument('--layers', type=int, default=60, help='Number of pixel layers')
+    parser.add_argument('--depth', type=int, default=3, help='Nesting depth of the groups, 0 for no groups')
+    parser.add_argument('--clips', type=int, default=6, help='Number of clip layers')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    config = generate(args.psd, args.size, args.layers, args.depth, args.clips, args.seed)
+    with open(os.path.splitext(args.psd)[0] + '.json', 'wt') as fp:
+        json.dump(config, fp, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,19 +1,30 @@
 
 import os
 import json
+import hashlib
 import tempfile
-import fnmatch
-import re
 import shutil
 
-from typing import Tuple, List, Dict
+from typing import Callable, Tuple, List, Dict
 
+import numpy as np
 from psd_tools import PSDImage
 from PIL import Image
 
-from models import ItemNode, AppState, Variation, Modifier
+from models import ItemNode, AppState, Variation, Modifier, ExportSettings, OutputFormat
+from layertable import LayerTable
+from compositor import Compositor, LayerRasterCache, GroupCompositeCache, MemoryBudget, CLIP_LAYER_PATH
+from rendercache import RenderCache
+from psdfile import openPSD, layerContentHash, MappedPSDFile
+from psdindex import PSDIndex
+from tracing import span, SPAN_PARSE, SPAN_HIERARCHY, SPAN_PATTERNS, SPAN_VISIBILITY, SPAN_COMPOSITE
+import utils
 
-CLIP_LAYER_PATH = 'clp'
+RENDER_CACHE_DIRNAME = 'render_cache'
+LAYER_INDEX_DIRNAME = 'layer_index'
+
+# The first pass of a progressive preview is this many times smaller than the final one
+PREVIEW_COARSE_DIVISOR = 4
 
 class App:
     """
@@ -22,31 +33,295 @@ class App:
 
     def __init__(self):
         self.psd:PSDImage = None
+        self.psdFile:MappedPSDFile = None # When lazily loaded
         self.thumbnail: Image.Image = None
         self.originalLayerHierarchy: List[ItemNode] = None
         self.originalPSDFilePath: str = None
+        self.psdHash: str = None
+        self.layerHashes: Dict[str, str] = None # By node path, see getLayerHashes
+        self.psdIndex: PSDIndex = None
+        self.renderCache: RenderCache = None
         self.variations:List[Variation] = []
         self.modifiers:List[Modifier] = []
+        self.exportSettings:ExportSettings = ExportSettings()
+        # Shared by the layer rasters, group composites and preview caches
+        self.memoryBudget: MemoryBudget = MemoryBudget(self.exportSettings.memoryBudgetMB * 1024 * 1024)
+        self.layerRasters: LayerRasterCache = LayerRasterCache(budget=self.memoryBudget)
+        self.groupComposites: GroupCompositeCache = GroupCompositeCache(budget=self.memoryBudget)
+        self.compositor: Compositor = None
+        self.previewCompositors: Dict[int, Compositor] = {} # By reduction factor
+        self.useLayerRasters: bool = False
+        self.layerTable: LayerTable = None
+        # Layers by node path and the PSD object they belong to, see layerHierarchy
+        self.layerIndex: Dict[str, object] = {}
+        self.layerIndexPSD: PSDImage = None
+        # Last state applied by applyVisibility, indexed like the layer table
+        self.appliedVisibility: np.ndarray = None
+
+    def readPSDIndex(self, fpath: str) -> PSDIndex:
+        """
+        Returns the sidecar index of a PSD file opened before, or None for a new or modified
+        file. The layer tree can be shown from it while loadPSD parses the file.
+        """
+        return PSDIndex.load(os.path.join(utils.getBasedir(), LAYER_INDEX_DIRNAME), fpath)
 
-    def loadPSD(self, fpath: str):
-        self.psd = PSDImage.open(fpath)
+    def loadPSD(self, fpath: str, index: PSDIndex = None):
+        if index is None:
+            index = self.readPSDIndex(fpath)
+        with span(SPAN_PARSE, file=os.path.basename(fpath)):
+            self.psd, self.psdFile = openPSD(fpath, self.exportSettings.lazyLoad)
         self.originalPSDFilePath = fpath
+        self.psdIndex = index
+        self.psdHash = index.psdHash if index is not None else None
+        self.layerHashes = index.layerHashes if index is not None else None
         # Clean up old state when loading a new PSD file
         self.thumbnail = None
-        self.originalLayerHierarchy = None
+        self.originalLayerHierarchy = index.toNodes() if index is not None else None
+        # The caches of the previous file are dropped with their share of the budget
+        self.memoryBudget.clear()
+        self.layerRasters = LayerRasterCache(budget=self.memoryBudget)
+        self.groupComposites = GroupCompositeCache(self.exportSettings.groupCacheMB * 1024 * 1024, self.memoryBudget)
+        self.compositor = None
+        self.previewCompositors = {}
+        self.useLayerRasters = index.compositorSupported if index is not None else Compositor.isSupported(self.psd)
+        self.layerTable = None
+        self.appliedVisibility = None
+        if index is None:
+            nodes = self.layerHierarchy(True)
+            self.psdIndex = PSDIndex.build(os.path.join(utils.getBasedir(), LAYER_INDEX_DIRNAME), fpath,
+                self.psd, nodes, self.layerIndex, self.useLayerRasters)
+            self.psdIndex.save()
+
+    def checkPSDFile(self):
+        """
+        Make sure a lazily loaded file is still the one that was mapped before reading pixels from it
+        """
+        if self.psdFile is not None and self.psdFile.changed():
+            raise OSError('{0} changed on disk since it was loaded, load it again'.format(self.originalPSDFilePath))
+
+    def releasePSDFile(self):
+        """
+        Read the rest of a lazily loaded file and unmap it, e.g. before waiting for it to be saved again
+        """
+        if self.psdFile is not None:
+            self.checkPSDFile()
+            self.psdFile.detach(self.psd)
+            self.psdFile = None
+
+    def getCompositor(self) -> Compositor:
+        """
+        Returns the compositor for the current PSD object. The layer rasters and group
+        composites are kept when the PSD object is replaced by a reload, since the pixels are the same.
+        """
+        if self.compositor is None or self.compositor.psd is not self.psd:
+            self.compositor = Compositor(self.psd, self.layerRasters, self.groupComposites, self.staticLayers())
+        return self.compositor
+
+    def cacheStats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Hits, misses and size of the in-process caches and of the memory budget they share.
+        The preview caches of every reduction factor are added up.
+        """
+        previews = [c for c in self.previewCompositors.values()]
+        stats = {
+            'layers': {'hits': self.layerRasters.hits, 'misses': self.layerRasters.misses, 'bytes': self.layerRasters.bytes},
+            'groups': {'hits': self.groupComposites.hits, 'misses': self.groupComposites.misses, 'bytes': self.groupComposites.bytes},
+            'previews': {'hits': sum(c.rasters.hits + c.groups.hits for c in previews),
+                         'misses': sum(c.rasters.misses + c.groups.misses for c in previews),
+                         'bytes': sum(c.rasters.bytes + c.groups.bytes for c in previews)},
+            'budget': {'maxBytes': self.memoryBudget.maxBytes, 'bytes': self.memoryBudget.bytes,
+                       'peakBytes': self.memoryBudget.peakBytes, 'evictions': self.memoryBudget.evictions},
+        }
+        if self.renderCache is not None:
+            stats['render'] = {'hits': self.renderCache.hits, 'misses': self.renderCache.misses}
+        return stats
+
+    def getRenderCache(self) -> RenderCache:
+        """
+        Returns the on-disk render cache, or None when it's disabled
+        """
+        maxBytes = self.exportSettings.renderCacheMB * 1024 * 1024
+        if maxBytes <= 0:
+            return None
+        if self.renderCache is None:
+            self.renderCache = RenderCache(os.path.join(utils.getBasedir(), RENDER_CACHE_DIRNAME), maxBytes)
+        self.renderCache.maxBytes = maxBytes
+        return self.renderCache
+
+    def getPSDHash(self) -> str:
+        """
+        Hash of the content of the PSD file, computed once per file
+        """
+        if self.psdHash is None:
+            self.psdHash = utils.fileHash(self.originalPSDFilePath)
+            if self.psdIndex is not None:
+                # Kept in the index, the next session doesn't read the whole file again
+                self.psdIndex.psdHash = self.psdHash
+                self.psdIndex.save()
+        return self.psdHash
+
+    def getLayerHashes(self) -> Dict[str, str]:
+        """
+        Hash of the content of every layer by node path, computed once per file
+        """
+        if self.layerHashes is None:
+            self.checkPSDFile()
+            self.layerHashes = {p: layerContentHash(self.getLayerByNodePath(p)) for p in self.getLayerTable().node_paths}
+            if self.psdIndex is not None:
+                self.psdIndex.layerHashes = self.layerHashes
+                self.psdIndex.save()
+        return self.layerHashes
+
+    def contentFingerprint(self, visibility:np.ndarray) -> str:
+        """
+        Fingerprint of what a state of the layer table renders: the size of the document
+        and the content of the layers that end up visible, in order. Unlike the hash of
+        the whole file, it stays the same when the PSD is saved with changes to layers
+        hidden in that state.
+        """
+        table = self.getLayerTable()
+        hashes = self.getLayerHashes()
+        shown = np.zeros(len(table), dtype=bool)
+        h = hashlib.sha1('{0}x{1}/{2}/{3}'.format(self.psd.width, self.psd.height, self.psd.depth, self.psd.color_mode).encode('utf-8'))
+        for i in range(len(table)):
+            # The parents come first in the table
+            parent = table.parents[i]
+            shown[i] = visibility[i] and (parent < 0 or shown[parent])
+            if shown[i]:
+                depth = table.node_paths[i].count('.')
+                h.update('{0}:{1};'.format(depth, hashes[table.node_paths[i]]).encode('ascii'))
+        return h.hexdigest()
+
+    def renderCacheKey(self, size: Tuple[int, int]) -> str:
+        """
+        Key of the current state of the layers rendered at the given size in the render cache
+        """
+        fingerprint = self.getLayerTable().fingerprint(self.currentVisibility())
+        return RenderCache.key(self.getPSDHash(), fingerprint, size)
+
+    def cachedRender(self, target_size: Tuple[int, int] = None) -> Image.Image:
+        """
+        Returns the render of the current state from the render cache, or None
+        """
+        cache = self.getRenderCache()
+        if cache is None or self.psd is None:
+            return None
+        size = self.psd.size if target_size is None else self.previewSize(target_size)
+        return cache.get(self.renderCacheKey(size))
 
     def renderPSD(self, target_size: Tuple[int, int] = None, reloadPSD:bool = False) -> Image.Image:
+        """
+        Composite the PSD with the current visibility of its layers. The render happens
+        in memory, reloadPSD forces the old save/reopen round trip of the whole document
+        and should only be needed to debug a rendering issue.
+        The render cache is looked up first. Previews (with a target_size) are stored in it,
+        full size renders are too big to encode on the spot and get stored by the exporter.
+        """
+        if not reloadPSD:
+            cached = self.cachedRender(target_size)
+            if cached is not None:
+                self.thumbnail = cached
+                return self.thumbnail
+        self.checkPSDFile()
         if reloadPSD:
             with tempfile.TemporaryDirectory() as tmpdir:
                 fpath = os.path.join(tmpdir, 'file.psd')
                 self.psd.save(fpath)
                 self.psd = PSDImage.open(fpath)
-        self.thumbnail = self.psd.composite(ignore_preview=True, force=True)
+        with span(SPAN_COMPOSITE, size=list(self.psd.size)):
+            if self.useLayerRasters:
+                # Composite from the rasterized layers, only the blending is paid for every render
+                self.thumbnail = self.getCompositor().composite()
+            else:
+                self.thumbnail = self.psd.composite(ignore_preview=True, force=True)
         if target_size is not None:
-            self.thumbnail.thumbnail(target_size, Image.ANTIALIAS)
+            self.thumbnail = self.fitPreview(self.thumbnail, target_size)
+            self.storeRender(self.thumbnail, target_size)
+        return self.thumbnail
+
+    def storeRender(self, image: Image.Image, target_size: Tuple[int, int] = None):
+        """
+        Store a render of the current state in the render cache, under the same
+        key cachedRender looks up for target_size
+        """
+        cache = self.getRenderCache()
+        if cache is not None:
+            size = self.psd.size if target_size is None else self.previewSize(target_size)
+            cache.put(self.renderCacheKey(size), image)
+
+    def fitPreview(self, image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
+        """
+        Like Image.thumbnail but returns a new image, the composites are kept by the compositor
+        """
+        ratio = min(target_size[0] / image.width, target_size[1] / image.height)
+        if ratio >= 1.0:
+            return image
+        size = (max(1, round(image.width * ratio)), max(1, round(image.height * ratio)))
+        return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+    def previewFactor(self, target_size: Tuple[int, int]) -> int:
+        """
+        Largest power of two the PSD can be reduced by and still fill the target size
+        """
+        ratio = min(target_size[0] / self.psd.width, target_size[1] / self.psd.height)
+        factor = 1
+        while factor * 2 * ratio <= 1.0:
+            factor *= 2
+        return factor
+
+    def previewSize(self, target_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Size of the preview of the PSD that fits in target_size, the PSD is never enlarged
+        """
+        ratio = min(target_size[0] / self.psd.width, target_size[1] / self.psd.height, 1.0)
+        return (max(1, round(self.psd.width * ratio)), max(1, round(self.psd.height * ratio)))
+
+    def previewPasses(self, target_size: Tuple[int, int]) -> List[Tuple[int, int]]:
+        """
+        Target sizes to render a preview progressively: a coarse one that's quick to
+        composite and then the requested one, when reducing the layers makes a difference
+        """
+        if not self.useLayerRasters:
+            return [target_size]
+        coarse = (max(1, target_size[0] // PREVIEW_COARSE_DIVISOR), max(1, target_size[1] // PREVIEW_COARSE_DIVISOR))
+        if self.previewFactor(coarse) <= self.previewFactor(target_size):
+            return [target_size]
+        return [coarse, target_size]
+
+    def renderPreview(self, target_size: Tuple[int, int], isCancelled: Callable[[], bool] = None) -> Image.Image:
+        """
+        Render the PSD to fit in target_size. The layers are downsampled before compositing,
+        so after the first preview the cost depends on the preview size and not on the canvas.
+        isCancelled is polled while compositing, the render stops with RenderCancelled once it returns True.
+        """
+        if not self.useLayerRasters:
+            return self.renderPSD(target_size)
+        cached = self.cachedRender(target_size)
+        if cached is not None:
+            self.thumbnail = cached
+            return self.thumbnail
+        self.checkPSDFile()
+        factor = self.previewFactor(target_size)
+        if factor == 1:
+            compositor = self.getCompositor()
+        else:
+            compositor = self.previewCompositors.get(factor)
+            if compositor is None:
+                # The reduced layers and groups are kept apart from the full resolution ones
+                compositor = Compositor(self.psd, LayerRasterCache(factor, self.layerRasters, self.memoryBudget),
+                    GroupCompositeCache(self.groupComposites.maxBytes // 4, self.memoryBudget), self.staticLayers())
+            elif compositor.psd is not self.psd:
+                compositor = Compositor(self.psd, compositor.rasters, compositor.groups, self.staticLayers())
+            self.previewCompositors[factor] = compositor
+        with span(SPAN_COMPOSITE, size=list(compositor.size()), preview=True):
+            self.thumbnail = compositor.composite(isCancelled)
+        self.thumbnail = self.fitPreview(self.thumbnail, target_size)
+        self.storeRender(self.thumbnail, target_size)
         return self.thumbnail
 
     def refreshState(self, state: AppState):
+        if state.psd is not self.psd:
+            self.appliedVisibility = None
         self.psd = state.psd
 
     def getState(self) -> AppState:
@@ -57,14 +332,19 @@ class App:
             # The original hierarchy was requested, and we have it. Return it directly
             return self.originalLayerHierarchy
 
+        # The layers get indexed by node path along the way
+        self.layerIndex = {}
+        self.layerIndexPSD = self.psd
         node_list = []
-        for i in range(len(list(self.psd))):
-            layer = self.psd[i]
-            node_path = str(i)
-            node = ItemNode(layer.name, layer.visible, node_path)
-            node_list.append(node)
-            node_list.extend(self.getClipLayers(layer, node_path))
-            node.children = self.getChildrenRecursive(layer, node_path)
+        with span(SPAN_HIERARCHY):
+            for i in range(len(list(self.psd))):
+                layer = self.psd[i]
+                node_path = str(i)
+                node = ItemNode(layer.name, layer.visible, node_path)
+                self.layerIndex[node_path] = layer
+                node_list.append(node)
+                node_list.extend(self.getClipLayers(layer, node_path))
+                node.children = self.getChildrenRecursive(layer, node_path)
 
         if self.originalLayerHierarchy is None:
             self.originalLayerHierarchy = node_list
@@ -76,6 +356,7 @@ class App:
             for i in range(len(list(layer.clip_layers))):
                 clip = layer.clip_layers[i]
                 node = ItemNode(clip.name, clip.visible, node_path + '.' + CLIP_LAYER_PATH + '.' + str(i))
+                self.layerIndex[node.node_path] = clip
                 clip_layers.append(node)
         return clip_layers
 
@@ -86,46 +367,100 @@ class App:
                 childLayer = parentLayer[i]
                 node_path = parent_path + '.' + str(i)
                 child = ItemNode(childLayer.name, childLayer.visible, node_path)
+                self.layerIndex[node_path] = childLayer
                 children.append(child)
                 children.extend(self.getClipLayers(childLayer, node_path))
                 child.children = self.getChildrenRecursive(childLayer, node_path)
         return children
     
     def getLayerByNodePath(self, node_path:str):
-        layer = None
-        parts = node_path.split('.')
-        parent = self.psd
-        for p in parts:
-            if p.isdigit():
-                layer = parent[int(p)]
-                parent = layer
-            elif p == CLIP_LAYER_PATH and hasattr(parent, 'clip_layers'):
-                parent = list(parent.clip_layers)
-        return layer
-
-    def updateLayersVisibility(self, layersTree:List[ItemNode]):
-        for i in range(len(layersTree)):
-            item = layersTree[i]
-            layer = self.getLayerByNodePath(item.node_path)
-            layer.visible = item.visible
-            if layer.is_group():
-                self.updateLayersVisibility(item.children)
+        if self.layerIndexPSD is not self.psd:
+            # The PSD object was replaced (e.g. reloaded), index its layers again
+            self.layerHierarchy()
+        return self.layerIndex.get(node_path)
+
+    def _dropCachedBBox(self, layer):
+        """
+        Older psd-tools releases memoize the bbox of the groups and don't reset it when
+        a descendant is toggled, so the group would still be composited with the extent
+        it had before. Drop it from the ancestors of the layer so it gets recomputed.
+        """
+        parent = getattr(layer, 'parent', None)
+        while parent is not None:
+            parent.__dict__.pop('_bbox', None)
+            parent = getattr(parent, 'parent', None)
+
+    def getLayerTable(self) -> LayerTable:
+        """
+        Returns the flat table of the original layer hierarchy, built on first use
+        """
+        if self.layerTable is None:
+            self.layerTable = LayerTable(self.layerHierarchy(True))
+        return self.layerTable
+
+    def currentVisibility(self) -> np.ndarray:
+        """
+        Returns the visibility the layers have right now
+        """
+        if self.appliedVisibility is not None:
+            return self.appliedVisibility.copy()
+        table = self.getLayerTable()
+        return np.array([self.getLayerByNodePath(p).visible for p in table.node_paths], dtype=bool)
+
+    def updateLayersVisibility(self, layersTree:List[ItemNode]) -> List[str]:
+        """
+        Apply the visibility of the node tree on the actual layers.
+        Returns the node paths of the layers that changed.
+        """
+        return self.applyVisibility(self.getLayerTable().fromNodes(layersTree, self.currentVisibility()))
+
+    def applyVisibility(self, visibility:np.ndarray) -> List[str]:
+        """
+        Apply a state of the layer table on the actual layers. Only the layers whose
+        visibility differs from the last applied state are looked up and touched.
+        Returns the node paths of the layers that changed.
+        """
+        table = self.getLayerTable()
+        if self.appliedVisibility is None:
+            ids = range(len(table))
+        else:
+            ids = np.flatnonzero(self.appliedVisibility != visibility)
+        changed = []
+        with span(SPAN_VISIBILITY):
+            for i in ids:
+                visible = bool(visibility[i])
+                layer = self.getLayerByNodePath(table.node_paths[i])
+                if layer.visible != visible:
+                    layer.visible = visible
+                    self._dropCachedBBox(layer)
+                    changed.append(table.node_paths[i])
+        self.appliedVisibility = visibility.copy()
+        return changed
 
     def loadVariationConfig(self, confFile:str) -> Tuple[List[Variation], List[Modifier]]:
-        self.variations = []
-        self.modifiers = []
+        data = {}
         if os.path.isfile(confFile):
             with open(confFile, 'rt') as fp:
-                data:Dict = json.load(fp)
-                self.variations =  [Variation.from_dict(x) for x in data.get('variations', [])]
-                self.modifiers = [Modifier.from_dict(x) for x in data.get('modifiers', [])]
+                data = json.load(fp)
+        return self.loadConfigDict(data)
 
+    def loadConfigDict(self, data:Dict) -> Tuple[List[Variation], List[Modifier]]:
+        self.variations =  [Variation.from_dict(x) for x in data.get('variations', [])]
+        self.modifiers = [Modifier.from_dict(x) for x in data.get('modifiers', [])]
+        self.exportSettings = ExportSettings.from_dict(data.get('export', {}))
+        self.groupComposites.maxBytes = self.exportSettings.groupCacheMB * 1024 * 1024
+        self.memoryBudget.maxBytes = self.exportSettings.memoryBudgetMB * 1024 * 1024
+        self.memoryBudget.evict()
+        self.updateStaticLayers()
         return (self.variations, self.modifiers)
-    
-    def saveVariationConfig(self, confFile:str) -> None:
+
+    def configDict(self) -> Dict:
         varDicts = [x.to_dict() for x in self.variations]
         modDicts = [m.to_dict() for m in self.modifiers]
-        data = {'variations': varDicts, 'modifiers': modDicts}
+        return {'variations': varDicts, 'modifiers': modDicts, 'export': self.exportSettings.to_dict()}
+    
+    def saveVariationConfig(self, confFile:str) -> None:
+        data = self.configDict()
         if os.path.exists(confFile):
             # Make a backup of the previous config file
             shutil.copyfile(confFile, confFile+'.bak')
@@ -144,47 +479,77 @@ class App:
             id = max([x.id for x in self.modifiers]) + 1
         return id
     
-    def _applyPatterns(self, item:ItemNode, patterns:List[str], visibility:bool = False) -> bool:
-        was_pattern_applied = False
-        # If a pattern matches, set the visibility, otherwise leave the node untouched
-        for patt in patterns:
-            # Apply the inclusions. Set it visible if it matches, leave it untouched otherwise
-            patt_type = patt[0:patt.find(':')]
-            patt_body = patt[patt.find(':')+1:]
-            if patt_type == 'blob' and fnmatch.fnmatch(item.label, patt_body):
-                item.visible = visibility
-                was_pattern_applied = True
-            else:
-                # Apply a regex
-                m = re.match(patt_body, item.label)
-                if m is not None:
-                    item.visible = visibility
-                    was_pattern_applied = True
-        return was_pattern_applied
-
-    def _applyVariationRecursive(self, variation:Variation, nodes:List[ItemNode]):
-        layersVisibility = []
-        for n in nodes:
-            item = ItemNode(n.label, n.visible, n.node_path)
-            self._applyPatterns(item, variation.inclusions, True)
-            self._applyPatterns(item, variation.exclusions)
-            layersVisibility.append(item)
-            if len(n.children) > 0:
-                item.children = self._applyVariationRecursive(variation, n.children)
-        return layersVisibility
+    def plannedVisibilities(self) -> List[np.ndarray]:
+        """
+        Final state of the layer table of every image an export writes
+        """
+        states = []
+        for v in self.variations:
+            visibility = self.variationVisibility(v)
+            mods = self.lookupVariationModifiers(v)
+            if len(mods) == 0:
+                states.append(visibility)
+                continue
+            combs = v.combinations if len(v.combinations) > 0 else utils.defaultCombinations(v, mods)
+            for c in combs:
+                states.append(self.modifiersVisibility(mods, c.bitflags, visibility))
+        return states
+
+    def staticLayers(self) -> Dict[str, bool]:
+        """
+        Layers that every image of an export shows or hides alike, by node path with that
+        visibility. With less than two images there's nothing to share.
+        """
+        if self.psd is None or not self.exportSettings.staticSlabs:
+            return {}
+        states = self.plannedVisibilities()
+        if len(states) < 2:
+            return {}
+        states = np.stack(states)
+        table = self.getLayerTable()
+        return {table.node_paths[i]: bool(states[0, i]) for i in np.flatnonzero(np.all(states == states[0], axis=0))}
+
+    def updateStaticLayers(self):
+        """
+        Update the slabs of the compositors after the variations or modifiers changed
+        """
+        if self.compositor is None and len(self.previewCompositors) == 0:
+            return
+        static = self.staticLayers()
+        for c in [self.compositor] + list(self.previewCompositors.values()):
+            if c is not None:
+                c.setStaticLayers(static)
+
+    def variationVisibility(self, variation:Variation, visibility:np.ndarray = None) -> np.ndarray:
+        """
+        Apply the inclusion and exclusion patterns of the specified variation on a state
+        of the layer table, the original visibility of the layers by default
+        """
+        table = self.getLayerTable()
+        if visibility is None:
+            visibility = table.visibility
+        with span(SPAN_PATTERNS, variation=variation.name):
+            return table.applyPatterns(visibility, variation.inclusionMatcher(), variation.exclusionMatcher())
 
     def applyVariation(self, variation:Variation, updateLayers:bool = False, nodes:List[ItemNode] = None) -> List[ItemNode]:
         """
         Apply the inclusion and exclusion patterns of the specified variation and return a 
         node tree representing the final state. Optionally apply the state on the actual layers
         """
-        if nodes is None:
-            nodes = self.layerHierarchy(True)
-        layersVisibility = self._applyVariationRecursive(variation, nodes)
+        table = self.getLayerTable()
+        visibility = self.variationVisibility(variation, None if nodes is None else table.fromNodes(nodes))
         if updateLayers:
-            self.updateLayersVisibility(layersVisibility)
-        return layersVisibility
+            self.applyVisibility(visibility)
+        return table.toNodes(visibility)
     
+    def outputFormatFor(self, variation:Variation) -> OutputFormat:
+        """
+        Returns the output format of the variation, the global one unless it has its own
+        """
+        if variation.outputFormat is not None:
+            return variation.outputFormat
+        return self.exportSettings.outputFormat
+
     def lookupVariationModifiers(self, variation:Variation) -> List[Modifier]:
         """
         Lookup the modifiers by the IDs specified in the variation
@@ -194,18 +559,6 @@ class App:
             mods.extend([x for x in self.modifiers if x.id == k])
         return mods
     
-    def _applyModifiersRecursive(self, modifiers:List[Modifier], nodes:List[ItemNode]) -> List[ItemNode]:
-        layersVisibility = []
-        for n in nodes:
-            item = ItemNode(n.label, n.visible, n.node_path)
-            for i in range(len(modifiers)):
-                self._applyPatterns(item, modifiers[i].inclusions, True)
-                self._applyPatterns(item, modifiers[i].exclusions)
-            layersVisibility.append(item)
-            if len(n.children) > 0:
-                item.children = self._applyModifiersRecursive(modifiers, n.children)
-        return layersVisibility
-
     def modifiersToApply(self, modifiers:List[Modifier], bitflags:str) -> List[Modifier]:
         """
         Takes the list of modifiers and returns a filtered copy with the
@@ -220,14 +573,26 @@ class App:
                 mods.append(modifiers[i])
         return mods
 
+    def modifiersVisibility(self, modifiers:List[Modifier], bitflags:str, visibility:np.ndarray = None) -> np.ndarray:
+        """
+        Apply the modifiers enabled by the bitflags string on a state of the layer table,
+        the current visibility of the layers by default
+        """
+        table = self.getLayerTable()
+        if visibility is None:
+            visibility = self.currentVisibility()
+        with span(SPAN_PATTERNS, combination=bitflags):
+            for m in self.modifiersToApply(modifiers, bitflags):
+                visibility = table.applyPatterns(visibility, m.inclusionMatcher(), m.exclusionMatcher())
+        return visibility
+
     def applyModifiers(self, modifiers:List[Modifier], bitflags:str, updateLayers:bool = False, nodes:List[ItemNode] = None):
         """
         Apply the corresponding modifiers based on the bitflags string and return a 
         node tree representing the final state. Optionally apply the state on the actual layers
         """
-        if nodes is None:
-            nodes = self.layerHierarchy()
-        layersVisibility = self._applyModifiersRecursive(self.modifiersToApply(modifiers, bitflags), nodes)
+        table = self.getLayerTable()
+        visibility = self.modifiersVisibility(modifiers, bitflags, None if nodes is None else table.fromNodes(nodes))
         if updateLayers:
-            self.updateLayersVisibility(layersVisibility)
-        return layersVisibility
+            self.applyVisibility(visibility)
+        return table.toNodes(visibility)
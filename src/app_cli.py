@@ -0,0 +1,153 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import contextlib
+from typing import Dict, List
+
+from app import App
+import batch
+import exporter
+import tracing
+import watch
+
+# The progress events are the only thing written to stdout, everything else goes to stderr
+EVENTS_STREAM = sys.stdout
+
+def printEvent(event:str, **kwargs):
+    """
+    Print a progress event as a single line of JSON, so other tools can follow the export
+    """
+    kwargs['event'] = event
+    print(json.dumps(kwargs), file=EVENTS_STREAM, flush=True)
+
+def parseArgs(argv:List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Export the variations of an illustration without starting the GUI')
+    parser.add_argument('psd', nargs='+',
+        help='The PSD file to export. Several files, folders or glob patterns export them all as a batch, '
+             'each one in its own subfolder of the output directory')
+    parser.add_argument('-c', '--config', required=True,
+        help='The variations_settings.json file with the variations and modifiers')
+    parser.add_argument('-o', '--output', required=True, help='The base output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Number of worker processes, 0 means one per CPU. Defaults to the config setting')
+    parser.add_argument('--batch-jobs', type=int, default=None,
+        help='PSD files of a batch exported at once, 0 sizes it to the CPUs and memory. Defaults to the config setting')
+    parser.add_argument('--full', action='store_true',
+        help='Render every image again, even the ones still up to date from a previous export')
+    parser.add_argument('--watch', action='store_true',
+        help='Keep running after the export and export every PSD file again when it is saved, '
+             'only the images showing a changed layer are rendered again')
+    parser.add_argument('--trace', default=None,
+        help='Write the timing of every step as a Chrome trace to this file (chrome://tracing, ui.perfetto.dev). '
+             'Single PSD files only')
+    parser.add_argument('--spans', default=None,
+        help='Write the timing of every step and a summary per step as JSON to this file. Single PSD files only')
+    return parser.parse_args(argv)
+
+def isBatch(inputs:List[str]) -> bool:
+    return len(inputs) > 1 or any(os.path.isdir(i) or glob.has_magic(i) for i in inputs)
+
+def main(argv:List[str]) -> int:
+    args = parseArgs(argv)
+    if not os.path.isfile(args.config):
+        printEvent('error', message='Config file not found', path=args.config)
+        return 1
+    app = App()
+    app.loadVariationConfig(args.config)
+    if args.jobs is not None:
+        app.exportSettings.jobs = args.jobs
+    batchMode = isBatch(args.psd)
+    watcher = None
+    if args.watch:
+        # The saves made while the first export runs are picked up afterwards
+        app.exportSettings.incremental = True
+        # A mapped file can't be saved on Windows, and could change under the reader elsewhere
+        app.exportSettings.lazyLoad = False
+        watcher = watch.PSDWatcher(args.psd)
+        watcher.markCurrent()
+    ret = runBatch(args, app) if batchMode else runSingle(args, app)
+    if watcher is None or ret == 1:
+        return ret
+    printEvent('watching', files=watcher.files())
+    def onEvent(event:Dict):
+        event = dict(event)
+        printEvent(event.pop('event'), **event)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            watch.runWatch(app, watcher, args.output, batchMode, onEvent)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def runSingle(args:argparse.Namespace, app:App) -> int:
+    psdFile = args.psd[0]
+    if not os.path.isfile(psdFile):
+        printEvent('error', message='PSD file not found', path=psdFile)
+        return 1
+    if app.exportSettings.trace and args.trace is None and args.spans is None:
+        # Enabled by the config, the files go with the exported images like in the GUI
+        args.trace = os.path.join(args.output, tracing.TRACE_FILENAME)
+        args.spans = os.path.join(args.output, tracing.SPANS_FILENAME)
+    tracing.TRACER.enable(args.trace is not None or args.spans is not None)
+    # Stdout only gets the events, the warnings of the loading and planning go to stderr too
+    with contextlib.redirect_stdout(sys.stderr):
+        printEvent('loading', psd=psdFile)
+        app.loadPSD(psdFile)
+        os.makedirs(args.output, exist_ok=True)
+        manifest = None
+        if app.exportSettings.incremental:
+            manifest = exporter.ExportManifest.load(args.output)
+        jobs = exporter.planExport(app, args.output, manifest)
+        printEvent('started', total=len(jobs), jobs=app.exportSettings.jobs,
+            changedLayers=manifest.changedLayers(app) if manifest is not None else None)
+        progress = {'done': 0}
+        def onExported(fname:str):
+            progress['done'] += 1
+            printEvent('exported', file=fname, done=progress['done'], total=len(jobs))
+        summary = exporter.runExport(app, jobs, app.exportSettings.jobs, onExported, manifest, args.full)
+        if args.trace is not None:
+            tracing.TRACER.saveChromeTrace(args.trace)
+        if args.spans is not None:
+            tracing.TRACER.saveJSON(args.spans)
+        printEvent('finished', total=summary.images, renders=summary.renders,
+            rendersSaved=summary.rendersSaved(), skipped=summary.skipped, seconds=summary.ellapsed,
+            peakRSS=summary.peakRSS, workersPeakRSS=summary.workersPeakRSS, caches=summary.caches)
+    return 0
+
+def runBatch(args:argparse.Namespace, app:App) -> int:
+    files = batch.expandInputs(args.psd)
+    if len(files) == 0:
+        printEvent('error', message='No PSD file found', path=args.psd)
+        return 1
+    if args.trace is not None or args.spans is not None:
+        # Every file gets its own traces in its subfolder, with "trace" in the config
+        printEvent('error', message='--trace and --spans only apply to a single PSD file, '
+            'set "trace" in the export section of the config to trace every file of a batch')
+        return 1
+    if args.batch_jobs is not None:
+        app.exportSettings.batchJobs = args.batch_jobs
+    with contextlib.redirect_stdout(sys.stderr):
+        batchFiles = batch.planBatch(files, args.output)
+        workers = batch.batchWorkers(batchFiles, app.exportSettings.batchJobs)
+    printEvent('batch_started', files=len(batchFiles), images=exporter.imageCount(app) * len(batchFiles),
+        workers=workers)
+    progress = {'done': 0}
+    def onEvent(event:Dict):
+        event = dict(event)
+        name = event.pop('event')
+        if name == 'exported':
+            progress['done'] += 1
+            event['done'] = progress['done']
+        printEvent(name, **event)
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = batch.runBatch(app, batchFiles, workers, onEvent, args.full)
+    printEvent('batch_finished', files=summary.files, exported=summary.exported, failed=summary.failed,
+        total=summary.images, renders=summary.renders, skipped=summary.skipped, seconds=summary.ellapsed,
+        peakRSS=summary.peakRSS)
+    return 0 if len(summary.failed) == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,24 @@
 import os
 import sys
 import time
-import math
-from typing import TYPE_CHECKING, List, Tuple
+import threading
+import traceback
+import multiprocessing
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 from PyQt5.QtWidgets import QMainWindow, QFileDialog, QApplication, QGraphicsScene, QProgressDialog, QAction, QMenu, QMessageBox
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, Qt
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, Qt
 from PyQt5.QtGui import QPixmap, QImage, QStandardItemModel, QStandardItem, QIcon, QCloseEvent
+from PIL import Image
 
-from models import ItemNode, AppState, Modifier, ModifierCombination
+from models import ItemNode, AppState
 import utils
 from app import App
+from compositor import RenderCancelled
+import exporter
+import batch
+import tracing
+import watch
 from gui import Ui_MainWindow
 from views import ModifierSettingsWindow, VariationSettingsWindow
 
@@ -26,6 +34,7 @@ class PSDLoadWorker(QObject):
 
     finished = pyqtSignal()
     psdLoaded = pyqtSignal(AppState)
+    layersIndexed = pyqtSignal(list) # Layer tree of a known file, emitted before it's parsed
 
     def __init__(self, psdFile:str, mainApp: 'App'):
         super(PSDLoadWorker, self).__init__()
@@ -34,27 +43,103 @@ class PSDLoadWorker(QObject):
 
     def run(self):
         print('Loading started...')
-        self.mainApp.loadPSD(self.psdFile)
+        index = self.mainApp.readPSDIndex(self.psdFile)
+        if index is not None:
+            self.layersIndexed.emit(index.toNodes())
+        self.mainApp.loadPSD(self.psdFile, index)
         self.psdLoaded.emit(self.mainApp.getState())
         self.finished.emit()
         print('Loading finished')
 
 class PSDRenderWorker(QObject):
+    """
+    Renders the previews on its own thread, one request at a time. Every preview is
+    rendered in passes from coarse to fine, and a newer request cancels the one in progress.
+    """
     finished = pyqtSignal()
     psdRendered = pyqtSignal(AppState)
+    renderFinished = pyqtSignal() # Emitted once there are no more requests waiting
 
-    def __init__(self, thumbnailSize:Tuple[int, int], mainApp: 'App', reloadPSD:bool = False):
+    def __init__(self, mainApp: 'App'):
         super(PSDRenderWorker, self).__init__()
-        self.thumbnailSize = thumbnailSize
         self.mainApp = mainApp
-        self.reloadPSD = reloadPSD
-    
+        self.condition = threading.Condition()
+        self.request:Tuple = None
+        self.generation = 0
+        self.stopped = False
+
+    def requestRender(self, thumbnailSize:Tuple[int, int], visibility = None, reloadPSD:bool = False):
+        """
+        Called from the GUI thread. The layers get the visibility (a state of the layer table)
+        on the render thread, so they are never touched while a render is going on.
+        """
+        with self.condition:
+            self.request = (thumbnailSize, visibility, reloadPSD)
+            self.generation += 1
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.generation += 1
+            self.condition.notify()
+
     def run(self):
+        while True:
+            with self.condition:
+                while self.request is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                request = self.request
+                generation = self.generation
+                self.request = None
+            self.render(generation, *request)
+            with self.condition:
+                idle = self.request is None
+            if idle:
+                self.renderFinished.emit()
+        self.finished.emit()
+
+    def render(self, generation:int, thumbnailSize:Tuple[int, int], visibility, reloadPSD:bool):
         print('Rendering started...')
         startTs = time.time()
-        self.mainApp.renderPSD(self.thumbnailSize, self.reloadPSD)
-        self.psdRendered.emit(self.mainApp.getState())
-        self.finished.emit()
+        isCancelled = lambda: self.generation != generation
+        try:
+            if visibility is not None:
+                self.mainApp.applyVisibility(visibility)
+            visibility = self.mainApp.currentVisibility()
+            if reloadPSD:
+                self.mainApp.renderPSD(thumbnailSize, True)
+                self.psdRendered.emit(AppState(self.mainApp.psd, self.mainApp.thumbnail, visibility))
+            else:
+                finalSize = self.mainApp.previewSize(thumbnailSize)
+                passes = self.mainApp.previewPasses(thumbnailSize)
+                cached = self.mainApp.cachedRender(thumbnailSize)
+                if cached is not None:
+                    # Rendered in a previous session, no need for the coarse pass
+                    self.mainApp.thumbnail = cached
+                    self.psdRendered.emit(AppState(self.mainApp.psd, cached, visibility))
+                    passes = []
+                elif len(passes) > 0:
+                    # Fail before the coarse pass rather than read a file saved since it was mapped
+                    self.mainApp.checkPSDFile()
+                for size in passes:
+                    im = self.mainApp.renderPreview(size, isCancelled)
+                    if im.size != finalSize:
+                        # Show the coarse passes at the size of the final one
+                        im = im.resize(finalSize, Image.BILINEAR)
+                    if isCancelled():
+                        raise RenderCancelled()
+                    self.psdRendered.emit(AppState(self.mainApp.psd, im, visibility))
+        except RenderCancelled:
+            print('Rendering cancelled')
+            return
+        except Exception as e:
+            # The thread keeps serving the next requests, e.g. once the file is loaded again
+            print('WARN: Rendering failed: {0}'.format(e))
+            traceback.print_exc()
+            return
         print('Rendering finished')
         diff = time.time() - startTs
         print('It took {0} seconds'.format(diff))
@@ -69,38 +154,64 @@ class PSDExportWorker(QObject):
         self.baseOutDir = baseOutDir
     
     def run(self):
-        totalStart = time.time()
-        baseFileName = os.path.basename(self.mainApp.originalPSDFilePath)
-        baseFileName = baseFileName[0:baseFileName.rfind('.')]
-        for v in self.mainApp.variations:
-            outDir = self.baseOutDir
-            if len(v.subfolder) > 0:
-                outDir = os.path.join(self.baseOutDir, v.subfolder)
-            os.makedirs(outDir, exist_ok=True)
-            nodes = self.mainApp.applyVariation(v)
-            mods = self.mainApp.lookupVariationModifiers(v)
-            combs = v.combinations
-            if len(mods) == 0:
-                # There are no modifiers, create an empty one with an empty combination
-                mods.append(Modifier.from_dict({'id': -1, 'name': '<Empty>'}))
-                combs.append(ModifierCombination.from_dict({'name': '<Empty>', 'bitflags': '0'}))
-            if len(combs) == 0:
-                combs = [ModifierCombination.from_dict({'name': utils.combinationName(mods, v.name, '{0:b}'.format(x)), 'bitflags': '{0:b}'.format(x)}) for x in range(int(math.pow(2, len(mods))))]
-            for c in combs:
-                imageStart = time.time()
-                modsToApply = self.mainApp.modifiersToApply(mods, c.bitflags)
-                suffix = utils.getSuffixFor(v, modsToApply)
-                fname = utils.getUniqueFilename(outDir, baseFileName + suffix, '.png')
-                self.mainApp.applyModifiers(mods, c.bitflags, True, nodes)
-                im = self.mainApp.renderPSD(reloadPSD=True)
-                im.save(fname)
-                self.imageExported.emit(fname)
-                imageEllapsed = time.time() - imageStart
-                print('Image exported in {0} seconds'.format(imageEllapsed))
+        manifest = None
+        if self.mainApp.exportSettings.incremental:
+            manifest = exporter.ExportManifest.load(self.baseOutDir)
+        jobs = exporter.planExport(self.mainApp, self.baseOutDir, manifest)
+        exporter.runExport(self.mainApp, jobs, self.mainApp.exportSettings.jobs, self.imageExported.emit, manifest)
+        if tracing.TRACER.enabled:
+            # Everything since the last export: loading, previews and this export
+            tracing.TRACER.saveChromeTrace(os.path.join(self.baseOutDir, tracing.TRACE_FILENAME))
+            tracing.TRACER.saveJSON(os.path.join(self.baseOutDir, tracing.SPANS_FILENAME))
+            tracing.TRACER.clear()
         self.finished.emit()
-        totalEllapsed = time.time() - totalStart
-        print('The process took {0} seconds'.format(totalEllapsed))
 
+class BatchExportWorker(QObject):
+    """
+    Export the variations of several PSD files, see batch.runBatch
+    """
+    finished:'PYQT_SIGNAL' = pyqtSignal(object) # The BatchSummary
+    batchEvent:'PYQT_SIGNAL' = pyqtSignal(dict)
+
+    def __init__(self, mainApp: 'App', files:List['batch.BatchFile'], workers:int) -> None:
+        super(BatchExportWorker, self).__init__()
+        self.mainApp = mainApp
+        self.files = files
+        self.workers = workers
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        # Called from the GUI thread, the files already started are finished
+        self.cancelled.set()
+
+    def run(self):
+        summary = batch.runBatch(self.mainApp, self.files, self.workers, self.batchEvent.emit,
+            isCancelled=self.cancelled.is_set)
+        self.finished.emit(summary)
+
+
+class WatchExportWorker(QObject):
+    """
+    Export a saved PSD file again, incrementally, see watch.runWatch
+    """
+    finished:'PYQT_SIGNAL' = pyqtSignal(dict) # The finished or failed event
+    batchEvent:'PYQT_SIGNAL' = pyqtSignal(dict)
+
+    def __init__(self, mainApp: 'App', psdFile:str, baseOutDir:str) -> None:
+        super(WatchExportWorker, self).__init__()
+        self.config = mainApp.configDict()
+        self.config['export']['incremental'] = True
+        self.config['export']['lazyLoad'] = False
+        self.jobs = mainApp.exportSettings.jobs
+        self.psdFile = psdFile
+        self.baseOutDir = baseOutDir
+
+    def run(self):
+        try:
+            result = batch.exportBatchFile(self.config, self.psdFile, self.baseOutDir, self.jobs, False, self.batchEvent.emit)
+            self.finished.emit(dict(result, event='finished', file=self.psdFile))
+        except Exception as e:
+            self.finished.emit({'event': 'failed', 'file': self.psdFile, 'message': str(e)})
 
 
 class TreeNodeItem(QStandardItem):
@@ -116,6 +227,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.modifierActionMenus:List[QMenu] = []
         self.baseOutDir = None
         self.exportProgressDialog = None
+        self.psdRenderThread:QThread = None
+        self.psdRenderWorker:PSDRenderWorker = None
+        self.layersFromIndex:bool = False # The tree view was filled before the PSD got parsed
         self.setupUi(self)
         self.setupExtraElements()
         self.loadSettings()
@@ -133,6 +247,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.treeLayersModel.setHeaderData(0, Qt.Horizontal, 'Layers')
         self.treeLayersModel.setHeaderData(1, Qt.Horizontal, 'Visible')
         self.treeLayers.setModel(self.treeLayersModel)
+        self.menuBatch = QMenu('Export', self)
+        self.actionBatchExport = QAction('Export files...', self)
+        self.menuBatch.addAction(self.actionBatchExport)
+        self.actionWatchExport = QAction('Export on save', self)
+        self.actionWatchExport.setCheckable(True)
+        self.menuBatch.addAction(self.actionWatchExport)
+        self.menubar.addAction(self.menuBatch.menuAction())
+        self.psdWatcher:watch.PSDWatcher = None
+        self.watchExportThread:QThread = None
+        self.watchTimer = QTimer(self)
+        self.watchTimer.setInterval(int(watch.WATCH_INTERVAL * 1000))
 
     def setupEvents(self):
         self.actionAddNewVariation.triggered.connect(self.onAddNewVariation)
@@ -142,10 +267,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.btnUpdatePreview.clicked.connect(self.onBtnUpdatePreviewClicked)
         self.btnBrowseOutputDir.clicked.connect(self.onBtnBrowseOutput)
         self.btnStart.clicked.connect(self.onBtnStart)
+        self.actionBatchExport.triggered.connect(self.onBatchExport)
+        self.actionWatchExport.toggled.connect(self.onWatchExportToggled)
+        self.watchTimer.timeout.connect(self.onWatchTimer)
         
         
     def loadSettings(self):
         self.mainApp.loadVariationConfig(VARIATIONS_CONFIG_FILEPATH)
+        tracing.TRACER.enable(self.mainApp.exportSettings.trace)
         self.updateMenus()
 
     def saveSettings(self):
@@ -209,10 +338,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.gsImage.clear()
         self.treeLayersModel.invisibleRootItem().setRowCount(0)
 
-    def updateLayersVisibility(self):
+    def treeVisibility(self):
+        """
+        Returns the state of the layer checkboxes as a state of the layer table
+        """
         rootItem = self.treeLayersModel.invisibleRootItem()
         node_list = self.getChildrenRecursively(rootItem)
-        self.mainApp.updateLayersVisibility(node_list)
+        return self.mainApp.getLayerTable().fromNodes(node_list)
     
     def getChildrenRecursively(self, item:QStandardItem):
         children = []
@@ -245,16 +377,19 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.psdLoadWorker.finished.connect(self.psdLoadWorker.deleteLater)
         self.psdLoadThread.finished.connect(self.psdLoadThread.deleteLater)
         self.psdLoadWorker.psdLoaded.connect(self.onPSDFileLoaded)
+        self.psdLoadWorker.layersIndexed.connect(self.onLayersIndexed)
+        self.layersFromIndex = False
 
     def startPSDLoad(self):
         self.psdLoadThread.start()
     
-    def preparePSDRender(self, reloadPSD:bool = False):
-        max_width = self.gvLoadedImage.width()
-        max_height = 10000
+    def preparePSDRender(self):
+        if self.psdRenderWorker is not None:
+            # The render thread stays around for all the previews
+            return
         # Create thread and worker
         self.psdRenderThread = QThread()
-        self.psdRenderWorker = PSDRenderWorker((max_width, max_height), self.mainApp, reloadPSD)
+        self.psdRenderWorker = PSDRenderWorker(self.mainApp)
         # Move worker to thread
         self.psdRenderWorker.moveToThread(self.psdRenderThread)
         # Connect signals
@@ -263,11 +398,22 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.psdRenderWorker.finished.connect(self.psdRenderWorker.deleteLater)
         self.psdRenderThread.finished.connect(self.psdRenderThread.deleteLater)
         self.psdRenderWorker.psdRendered.connect(self.onPSDRendered)
-        self.psdRenderWorker.finished.connect(self.onPSDRenderFinished)
-    
-    def startPSDRender(self):
+        self.psdRenderWorker.renderFinished.connect(self.onPSDRenderFinished)
         self.psdRenderThread.start()
     
+    def startPSDRender(self, reloadPSD:bool = False):
+        max_width = self.gvLoadedImage.width()
+        max_height = 10000
+        self.psdRenderWorker.requestRender((max_width, max_height), self.treeVisibility(), reloadPSD)
+
+    def stopPSDRender(self):
+        if self.psdRenderWorker is not None:
+            self.psdRenderWorker.stop()
+            self.psdRenderThread.quit()
+            self.psdRenderThread.wait()
+            self.psdRenderWorker = None
+            self.psdRenderThread = None
+    
     def prepareExportWorker(self):
         # Create thread and worker
         self.exportWorkerThread = QThread()
@@ -287,21 +433,40 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.exportWorkerThread.start()
     
     def prepareExportProgress(self):
-        self.totalImagesToExport = 0
+        # Every planned file is reported once, whether it's rendered, linked to an identical one or skipped
+        self.totalImagesToExport = exporter.imageCount(self.mainApp)
         self.currentImagesExported = 0
-        for v in self.mainApp.variations:
-            if len(v.modifiers) == 0:
-                self.totalImagesToExport += 1
-            elif len(v.combinations) > 0:
-                self.totalImagesToExport += len(v.combinations)
-            else:
-                self.totalImagesToExport += int(math.pow(2, len(v.modifiers)))
-        self.exportProgressDialog = QProgressDialog('Exporting...', 'Cancel', 0, self.totalImagesToExport, self)
+        self.exportProgressDialog = QProgressDialog('Exporting...', 'Cancel', 0, max(self.totalImagesToExport, 1), self)
         self.exportProgressDialog.setWindowFlag(Qt.WindowContextHelpButtonHint, False)
         self.exportProgressDialog.setWindowModality(Qt.WindowModal)
 
-    def loadLayersTreeview(self, original:bool = False):
-        layers = list(reversed(self.mainApp.layerHierarchy(original)))
+    def prepareBatchExport(self, files:List['batch.BatchFile'], workers:int):
+        self.batchImagesPerFile = exporter.imageCount(self.mainApp)
+        self.batchFilesStarted = 0
+        self.batchExported:Dict[str, int] = {}
+        self.batchProgress = 0
+        self.batchProgressDialog = QProgressDialog('Exporting {0} files...'.format(len(files)), 'Cancel',
+            0, max(self.batchImagesPerFile * len(files), 1), self)
+        self.batchProgressDialog.setWindowFlag(Qt.WindowContextHelpButtonHint, False)
+        self.batchProgressDialog.setWindowModality(Qt.WindowModal)
+        self.batchProgressDialog.setAutoClose(False)
+        self.batchProgressDialog.setAutoReset(False)
+        self.batchExportThread = QThread()
+        self.batchExportWorker = BatchExportWorker(self.mainApp, files, workers)
+        self.batchExportWorker.moveToThread(self.batchExportThread)
+        self.batchExportThread.started.connect(self.batchExportWorker.run)
+        self.batchExportWorker.batchEvent.connect(self.onBatchEvent)
+        self.batchExportWorker.finished.connect(self.onBatchFinished)
+        self.batchExportWorker.finished.connect(self.batchExportThread.quit)
+        self.batchExportWorker.finished.connect(self.batchExportWorker.deleteLater)
+        self.batchExportThread.finished.connect(self.batchExportThread.deleteLater)
+        # A direct call, the worker thread is busy until the batch ends
+        self.batchProgressDialog.canceled.connect(lambda: self.batchExportWorker.cancel())
+
+    def loadLayersTreeview(self, original:bool = False, nodes:List[ItemNode] = None):
+        if nodes is None:
+            nodes = self.mainApp.layerHierarchy(original)
+        layers = list(reversed(nodes))
         rootItem = self.treeLayersModel.invisibleRootItem()
         rootItem.setRowCount(0)
         for i in range(len(layers)):
@@ -321,16 +486,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 child = childrenReverse[i]
                 self.loadChildrenRecursive(child, layerItem, i)
     
-    def refreshLayersTreeview(self, original:bool = False, refreshVisibility:bool = False):
-        layers = list(reversed(self.mainApp.layerHierarchy(original)))
+    def refreshLayersTreeview(self, original:bool = False, refreshVisibility:bool = False, nodes:List[ItemNode] = None,
+            refreshChecks:bool = True):
+        if nodes is None:
+            nodes = self.mainApp.layerHierarchy(original)
+        layers = list(reversed(nodes))
         rootItem = self.treeLayersModel.invisibleRootItem()
         for i in range(len(layers)):
             lay = layers[i]
-            self.refreshChildrenRecursive(lay, rootItem, i, refreshVisibility)
+            self.refreshChildrenRecursive(lay, rootItem, i, refreshVisibility, refreshChecks)
     
-    def refreshChildrenRecursive(self, nodeLayer:ItemNode, parentItem:QStandardItem, index:int, refreshVisibility:bool):
+    def refreshChildrenRecursive(self, nodeLayer:ItemNode, parentItem:QStandardItem, index:int, refreshVisibility:bool,
+            refreshChecks:bool = True):
         layerItem = parentItem.child(index, 0)
-        layerItem.setCheckState(Qt.Checked if nodeLayer.visible else Qt.Unchecked)
+        if refreshChecks:
+            layerItem.setCheckState(Qt.Checked if nodeLayer.visible else Qt.Unchecked)
         if refreshVisibility:
             visibilityItem = parentItem.child(index, 1)
             visibilityItem.setText('Yes' if nodeLayer.visible else 'No')
@@ -338,11 +508,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             childrenReverse = list(reversed(nodeLayer.children))
             for i in range(len(childrenReverse)):
                 child = childrenReverse[i]
-                self.refreshChildrenRecursive(child, layerItem, i, refreshVisibility)
+                self.refreshChildrenRecursive(child, layerItem, i, refreshVisibility, refreshChecks)
     
     def resetLayersState(self):
         if self.mainApp.psd is not None:
             self.refreshLayersTreeview(True)
+        # The variations or modifiers changed, so may the layers they never toggle
+        self.mainApp.updateStaticLayers()
         # Reload the menus to clear all the checked items
         self.updateMenus()
 
@@ -358,9 +530,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def onPSDRenderFinished(self):
         self.btnBrowseInput.setEnabled(True)
-        self.loadingInProgress.setRange(0,1)
-        self.loadingInProgress.setValue(1)
-        self.loadingInProgress.deleteLater()
+        self.checkBtnStart()
 
     def onPSDFileLoaded(self, appState:AppState):
         print('onPSDFileLoaded slot')
@@ -370,13 +540,22 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.loadingInProgress.setRange(0,1)
         self.loadingInProgress.setValue(1)
         self.loadingInProgress.deleteLater()
-        self.loadLayersTreeview()
+        if not self.layersFromIndex:
+            self.loadLayersTreeview()
         self.btnResetLayers.setEnabled(True)
         self.btnUpdatePreview.setEnabled(True)
         self.checkBtnStart()
         # Reload the menu
         self.updateMenus()
+        if self.actionWatchExport.isChecked():
+            # Watch the new file instead
+            self.onWatchExportToggled(True)
     
+    def onLayersIndexed(self, nodes:List[ItemNode]):
+        # Same tree the PSD will give once parsed, the index only matches an unchanged file
+        self.loadLayersTreeview(nodes = nodes)
+        self.layersFromIndex = True
+
     def onPSDRendered(self, appState:AppState):
         print('onPSDRendered slot')
         self.mainApp.refreshState(appState)
@@ -390,9 +569,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.gsImage.addPixmap(self.loadedImage)
         self.gvLoadedImage.setScene(self.gsImage)
         print('psdFileLoaded slot end')
-        self.refreshLayersTreeview(refreshVisibility = True)
-        self.btnResetLayers.setEnabled(True)
-        self.btnUpdatePreview.setEnabled(True)
+        # Only the Visible column, the checkboxes may have changed since the preview was requested
+        nodes = self.mainApp.getLayerTable().toNodes(appState.visibility)
+        self.refreshLayersTreeview(refreshVisibility = True, nodes = nodes, refreshChecks = False)
 
     def onBtnBrowseInputClicked(self):
         psd_file, _ign = QFileDialog.getOpenFileName(self, 'Open PSD file', filter='PhotoShop File (*.psd)')
@@ -408,13 +587,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     
     def onBtnUpdatePreviewClicked(self):
         if self.mainApp.psd is not None:
-            self.updateLayersVisibility()
-            self.gsImage.clear()
-            self.btnUpdatePreview.setEnabled(False)
-            self.btnResetLayers.setEnabled(False)
-            self.preparePSDRender(True)
+            # The layers belong to the render thread until it's done,
+            # a click while a preview is on its way replaces it
+            self.btnBrowseInput.setEnabled(False)
+            self.btnStart.setEnabled(False)
+            self.preparePSDRender()
             self.startPSDRender()
-            self.prepareLoadingDialog('Rendering PSD...')
 
     def onBtnReset(self):
         self.resetLayersState()
@@ -457,8 +635,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                         act.setChecked(False)
             # Finally apply the variation
             variation = self.mainApp.variations[index]
-            self.mainApp.applyVariation(variation, True)
-            self.refreshLayersTreeview()
+            visibility = self.mainApp.variationVisibility(variation)
+            self.refreshLayersTreeview(nodes = self.mainApp.getLayerTable().toNodes(visibility))
             winTitle += ' - ' + variation.name
         
         self.setWindowTitle(winTitle)
@@ -484,7 +662,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             QMessageBox.warning(self, 'Warning', 'This modifier is not linked to the active variation')
             checkedAct.setChecked(False)
             return
-        nodes = self.mainApp.applyVariation(activeVariation)
+        visibility = self.mainApp.variationVisibility(activeVariation)
         bitflags = ''
         for m in mods:
             idx = utils.findIndex(self.mainApp.modifiers, m)
@@ -500,8 +678,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             winTitle += '|'.join([m.name for m in activeMods])
             winTitle += ']'
         self.setWindowTitle(winTitle)
-        self.mainApp.applyModifiers(mods, bitflags, True, nodes)
-        self.refreshLayersTreeview()
+        visibility = self.mainApp.modifiersVisibility(mods, bitflags, visibility)
+        self.refreshLayersTreeview(nodes = self.mainApp.getLayerTable().toNodes(visibility))
     
     def onDeleteVariation(self, index:int):
         variation = self.mainApp.variations[index]
@@ -556,14 +734,126 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.currentImagesExported += 1
         self.exportProgressDialog.setValue(self.currentImagesExported)
 
+    def onBatchExport(self):
+        psdFiles, _ = QFileDialog.getOpenFileNames(self, 'Select the PSD files to export', '', 'PSD Files (*.psd)')
+        if len(psdFiles) == 0:
+            return
+        outDir = QFileDialog.getExistingDirectory(self, 'Select the output directory')
+        if outDir == '':
+            return
+        files = batch.planBatch(psdFiles, outDir)
+        workers = batch.batchWorkers(files, self.mainApp.exportSettings.batchJobs)
+        self.prepareBatchExport(files, workers)
+        self.toggleAllButtons(False)
+        self.menuBatch.setEnabled(False)
+        self.batchExportThread.start()
+
+    def onBatchEvent(self, event:Dict):
+        name = os.path.basename(event['file'])
+        if event['event'] == 'started':
+            self.batchFilesStarted += 1
+            self.batchProgressDialog.setLabelText('Exporting file {0} of {1}: {2}'.format(
+                self.batchFilesStarted, len(self.batchExportWorker.files), name))
+        elif event['event'] == 'exported':
+            print('Image exported to {0}'.format(event['path']))
+            self.batchExported[event['file']] = self.batchExported.get(event['file'], 0) + 1
+            self.batchProgress += 1
+        elif event['event'] == 'failed':
+            print('WARN: Could not export {0}: {1}'.format(event['file'], event['message']))
+            # Count the images it won't export, so the bar still ends full
+            self.batchProgress += max(self.batchImagesPerFile - self.batchExported.get(event['file'], 0), 0)
+        self.batchProgressDialog.setValue(self.batchProgress)
+
+    def onBatchFinished(self, summary:'batch.BatchSummary'):
+        self.batchProgressDialog.deleteLater()
+        self.toggleAllButtons(True)
+        self.checkBtnStart()
+        self.menuBatch.setEnabled(True)
+        message = '{0} of {1} files exported, {2} images.'.format(summary.exported, summary.files, summary.images)
+        if summary.cancelled > 0:
+            message += '\n{0} files cancelled.'.format(summary.cancelled)
+        if len(summary.failed) > 0:
+            message += '\nFailed:\n' + '\n'.join('{0}: {1}'.format(os.path.basename(f), m) for f, m in summary.failed.items())
+            QMessageBox.warning(self, 'Batch export', message)
+        else:
+            QMessageBox.information(self, 'Batch export', message)
+
+    def onWatchExportToggled(self, checked:bool):
+        if not checked:
+            self.watchTimer.stop()
+            self.psdWatcher = None
+            self.statusbar.clearMessage()
+            return
+        if self.mainApp.originalPSDFilePath is None or self.baseOutDir is None:
+            QMessageBox.information(self, 'Export on save', 'Load a PSD file and select the output directory first.')
+            self.actionWatchExport.setChecked(False)
+            return
+        try:
+            # A mapped file can't be saved by Photoshop on Windows
+            self.mainApp.releasePSDFile()
+        except OSError as e:
+            QMessageBox.warning(self, 'Export on save', str(e))
+            self.actionWatchExport.setChecked(False)
+            return
+        # The file as it is now was exported with the start button, or will be
+        self.psdWatcher = watch.PSDWatcher([self.mainApp.originalPSDFilePath])
+        self.psdWatcher.markCurrent()
+        self.watchTimer.start()
+        self.statusbar.showMessage('Watching {0}'.format(os.path.basename(self.mainApp.originalPSDFilePath)))
+
+    def onWatchTimer(self):
+        if self.psdWatcher is None or self.watchExportThread is not None:
+            # The saves made meanwhile are picked up once the current export ends
+            return
+        changed = self.psdWatcher.poll()
+        if len(changed) == 0:
+            return
+        self.statusbar.showMessage('Exporting {0}...'.format(os.path.basename(changed[0])))
+        self.watchExportThread = QThread()
+        self.watchExportWorker = WatchExportWorker(self.mainApp, changed[0], self.baseOutDir)
+        self.watchExportWorker.moveToThread(self.watchExportThread)
+        self.watchExportThread.started.connect(self.watchExportWorker.run)
+        self.watchExportWorker.batchEvent.connect(self.onWatchEvent)
+        self.watchExportWorker.finished.connect(self.onWatchExportFinished)
+        self.watchExportWorker.finished.connect(self.watchExportThread.quit)
+        self.watchExportWorker.finished.connect(self.watchExportWorker.deleteLater)
+        self.watchExportThread.finished.connect(self.watchExportThread.deleteLater)
+        self.watchExportThread.start()
+
+    def onWatchEvent(self, event:Dict):
+        if event['event'] == 'started' and event.get('changedLayers') is not None:
+            print('Layers changed since the last export: {0}'.format(', '.join(event['changedLayers'])))
+        elif event['event'] == 'exported':
+            print('Image exported to {0}'.format(event['path']))
+
+    def onWatchExportFinished(self, event:Dict):
+        self.watchExportThread = None
+        name = os.path.basename(event['file'])
+        if event['event'] == 'failed':
+            print('WARN: Could not export {0}: {1}'.format(event['file'], event['message']))
+            self.statusbar.showMessage('Could not export {0}, watching it for the next save'.format(name))
+        else:
+            self.statusbar.showMessage('{0} exported at {1}: {2} images rendered again, {3} up to date'.format(
+                name, time.strftime('%H:%M:%S'), event['renders'], event['skipped']))
+
     def onClosed(self, targetName: str):
         print(targetName + " was closed")
 
     def closeEvent(self, event: QCloseEvent):
+        self.stopPSDRender()
+        self.watchTimer.stop()
+        if self.watchExportThread is not None:
+            self.watchExportThread.quit()
+            self.watchExportThread.wait()
+        cache = self.mainApp.getRenderCache()
+        if cache is not None:
+            cache.saveStats()
         self.saveSettings()
         event.accept()
 
 def main(app: 'App'):
+    # Needed by the export process pool on bundled Windows builds
+    multiprocessing.freeze_support()
     qtApp = QApplication(sys.argv)
     window = MainWindow(mApp=app)
     window.show()
@@ -0,0 +1,251 @@
+import os
+import sys
+import glob
+import time
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Tuple
+
+from app import App
+from psdfile import readCanvasSize
+import exporter
+import tracing
+import utils
+
+# Memory a batch worker takes besides the document, and per byte of its RGBA canvas
+# (the decoded layers and the intermediate composites), to size the pool. Measured
+# peaks of exports, they're only estimates
+WORKER_BASE_BYTES = 256 * 1024 * 1024
+WORKER_CANVAS_FACTOR = 24
+
+class BatchFile:
+    """
+    A PSD file of a batch and the folder its images go to
+    """
+    def __init__(self, psdPath:str, outDir:str):
+        self.psdPath:str = psdPath
+        self.outDir:str = outDir
+        self.canvasSize:Tuple[int, int] = (0, 0)
+
+    def estimatedBytes(self) -> int:
+        return WORKER_BASE_BYTES + WORKER_CANVAS_FACTOR * self.canvasSize[0] * self.canvasSize[1] * 4
+
+    def __repr__(self) -> str:
+        return '<BatchFile psd="{0}", outDir="{1}">'.format(self.psdPath, self.outDir)
+
+
+class BatchSummary:
+    def __init__(self) -> None:
+        self.files:int = 0
+        self.exported:int = 0 # Files exported completely
+        self.failed:Dict[str, str] = {} # Error message by PSD path
+        self.cancelled:int = 0 # Files never started
+        self.images:int = 0
+        self.renders:int = 0
+        self.skipped:int = 0
+        self.ellapsed:float = 0.0
+        self.workers:int = 0
+        self.peakRSS:int = None # Bytes, of the largest worker
+
+    def __repr__(self) -> str:
+        return '<BatchSummary files={0}, exported={1}, failed={2}, images={3}, ellapsed={4}>'.format(
+            self.files, self.exported, len(self.failed), self.images, self.ellapsed)
+
+
+def expandInputs(inputs:List[str]) -> List[str]:
+    """
+    Returns the PSD files named by a list of paths, glob patterns and folders (all the
+    PSD files in them), without duplicates and in the given order
+    """
+    found = []
+    for i in inputs:
+        if os.path.isdir(i):
+            matches = sorted(glob.glob(os.path.join(glob.escape(i), '*.psd')))
+        elif glob.has_magic(i):
+            matches = sorted(glob.glob(i, recursive=True))
+        else:
+            matches = [i]
+        found.extend(m for m in matches if os.path.isfile(m))
+    result = []
+    seen = set()
+    for f in found:
+        key = os.path.normcase(os.path.abspath(f))
+        if key not in seen:
+            seen.add(key)
+            result.append(f)
+    return result
+
+def planBatch(psdPaths:List[str], baseOutDir:str) -> List[BatchFile]:
+    """
+    Give every PSD file its own folder in the output directory, named after the file.
+    The folder names stay the same from one batch to the next, so incremental exports
+    find their manifests again.
+    """
+    files = []
+    used = set()
+    for p in psdPaths:
+        name = os.path.splitext(os.path.basename(p))[0]
+        folder = name
+        i = 1
+        while os.path.normcase(folder) in used:
+            folder = '{0}_{1}'.format(name, i)
+            i += 1
+        used.add(os.path.normcase(folder))
+        f = BatchFile(p, os.path.join(baseOutDir, folder))
+        try:
+            f.canvasSize = readCanvasSize(p)
+        except (OSError, ValueError) as e:
+            print('WARN: Could not read the size of {0}: {1}'.format(p, e))
+        files.append(f)
+    return files
+
+def batchWorkers(files:List[BatchFile], jobs:int = 0) -> int:
+    """
+    Number of files to export at once. With jobs at 0 it's one per CPU, as long as the
+    estimated memory of the largest files fits in the available memory.
+    """
+    if len(files) == 0:
+        return 1
+    if jobs > 0:
+        return min(jobs, len(files))
+    workers = min(os.cpu_count() or 1, len(files))
+    available = utils.availableMemory()
+    if available is not None:
+        largest = max(f.estimatedBytes() for f in files)
+        workers = min(workers, max(int(available // largest), 1))
+    return workers
+
+def runBatch(app:App, files:List[BatchFile], workers:int = 1, onEvent:Callable[[Dict], None] = None,
+        force:bool = False, isCancelled:Callable[[], bool] = None) -> BatchSummary:
+    """
+    Export all the variations of the app config for every file. With several workers every
+    file is exported by a single process, up to workers of them at once and the largest
+    files first. With one they're exported here one after the other, with the jobs of the
+    export settings. onEvent gets the progress as dicts: started (file, images and the
+    changedLayers since the last export), exported (file, path), finished (file and its
+    export summary) and failed (file, message).
+    Once isCancelled returns True the files not started yet are left out.
+    """
+    totalStart = time.time()
+    summary = BatchSummary()
+    summary.files = len(files)
+    summary.workers = workers
+    config = app.configDict()
+    # Spread the large files first, so no large one is left alone at the end
+    ordered = sorted(files, key=lambda f: f.canvasSize[0] * f.canvasSize[1], reverse=True)
+    def emit(event:Dict):
+        if onEvent is not None:
+            onEvent(event)
+    def done(f:BatchFile, result:Dict = None, error:BaseException = None):
+        if error is not None:
+            summary.failed[f.psdPath] = str(error)
+            emit({'event': 'failed', 'file': f.psdPath, 'message': str(error)})
+            return
+        summary.exported += 1
+        summary.images += result['images']
+        summary.renders += result['renders']
+        summary.skipped += result['skipped']
+        if result['peakRSS'] is not None:
+            summary.peakRSS = max(summary.peakRSS or 0, result['peakRSS'])
+        emit(dict(result, event='finished', file=f.psdPath))
+
+    if workers <= 1:
+        for f in ordered:
+            if isCancelled is not None and isCancelled():
+                summary.cancelled += 1
+                continue
+            try:
+                done(f, exportBatchFile(config, f.psdPath, f.outDir, app.exportSettings.jobs, force, emit))
+            except Exception as e:
+                done(f, error=e)
+    else:
+        events = multiprocessing.Queue()
+        initargs = (events, sys.stdout is sys.stderr)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=initargs) as pool:
+            futures:Dict[Future, BatchFile] = {}
+            for f in ordered:
+                futures[pool.submit(_exportFile, config, f.psdPath, f.outDir, force)] = f
+            pending = set(futures.keys())
+            while len(pending) > 0:
+                finished, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                _drain(events, emit)
+                for future in finished:
+                    if future.cancelled():
+                        summary.cancelled += 1
+                    elif future.exception() is not None:
+                        done(futures[future], error=future.exception())
+                    else:
+                        done(futures[future], future.result())
+                if isCancelled is not None and isCancelled():
+                    for future in pending:
+                        future.cancel()
+            _drain(events, emit)
+    summary.ellapsed = time.time() - totalStart
+    print('The batch took {0} seconds: {1} of {2} files exported, {3} failed, {4} images'.format(
+        summary.ellapsed, summary.exported, summary.files, len(summary.failed), summary.images))
+    return summary
+
+def exportBatchFile(config:Dict, psdPath:str, outDir:str, jobs:int = 1, force:bool = False,
+        onEvent:Callable[[Dict], None] = None) -> Dict:
+    """
+    Export all the variations of a single file of a batch with jobs processes, see runExport.
+    Returns the export summary as a dict. With tracing on, the traces of the file are written
+    to its output folder.
+    """
+    app = App()
+    app.loadConfigDict(config)
+    if not app.exportSettings.trace:
+        return _exportBatchFile(app, psdPath, outDir, jobs, force, onEvent)
+    # The spans recorded before, e.g. by the previews of the GUI, are put back afterwards
+    earlier = tracing.TRACER.take()
+    wasEnabled = tracing.TRACER.enabled
+    tracing.TRACER.enable(True)
+    try:
+        result = _exportBatchFile(app, psdPath, outDir, jobs, force, onEvent)
+        tracing.TRACER.saveChromeTrace(os.path.join(outDir, tracing.TRACE_FILENAME))
+        tracing.TRACER.saveJSON(os.path.join(outDir, tracing.SPANS_FILENAME))
+    finally:
+        tracing.TRACER.take()
+        tracing.TRACER.add(earlier)
+        tracing.TRACER.enable(wasEnabled)
+    return result
+
+def _exportBatchFile(app:App, psdPath:str, outDir:str, jobs:int, force:bool, onEvent:Callable[[Dict], None]) -> Dict:
+    app.loadPSD(psdPath)
+    os.makedirs(outDir, exist_ok=True)
+    manifest = None
+    if app.exportSettings.incremental:
+        manifest = exporter.ExportManifest.load(outDir)
+    exportJobs = exporter.planExport(app, outDir, manifest)
+    if onEvent is not None:
+        event = {'event': 'started', 'file': psdPath, 'images': len(exportJobs)}
+        if manifest is not None:
+            event['changedLayers'] = manifest.changedLayers(app)
+        onEvent(event)
+    def onExported(fname:str):
+        if onEvent is not None:
+            onEvent({'event': 'exported', 'file': psdPath, 'path': fname})
+    summary = exporter.runExport(app, exportJobs, jobs, onExported, manifest, force)
+    return {'images': summary.images, 'renders': summary.renders, 'skipped': summary.skipped,
+            'seconds': summary.ellapsed, 'peakRSS': summary.peakRSS}
+
+def _drain(events, emit:Callable[[Dict], None]):
+    while True:
+        try:
+            emit(events.get_nowait())
+        except queue.Empty:
+            return
+
+# Progress queue of the worker processes, shared with the batch
+_workerEvents = None
+
+def _initWorker(events, stdoutToStderr:bool):
+    global _workerEvents
+    if stdoutToStderr:
+        sys.stdout = sys.stderr
+    _workerEvents = events
+
+def _exportFile(config:Dict, psdPath:str, outDir:str, force:bool) -> Dict:
+    # The files are already spread over the processes, each one is exported by a single one
+    return exportBatchFile(config, psdPath, outDir, 1, force, _workerEvents.put)
@@ -0,0 +1,715 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import AdjustmentLayer
+from psd_tools.constants import BlendMode, ColorMode, Clipping
+from psd_tools.composite.blend import BLEND_FUNC
+
+CLIP_LAYER_PATH = 'clp'
+# Memory the isolated group composites may take, see GroupCompositeCache
+GROUP_CACHE_BYTES = 512 * 1024 * 1024
+# Above this share of the canvas, compositing everything is cheaper than patching the previous composite
+DIRTY_REGION_MAX_SHARE = 0.5
+# Visible layers a run of static layers needs to be worth compositing into a slab
+SLAB_MIN_LAYERS = 2
+
+class RenderCancelled(Exception):
+    """
+    Raised by Compositor.composite when the render was cancelled halfway
+    """
+    pass
+
+
+class LayerRaster:
+    """
+    Rendered pixels of a single layer (with its mask, effects and opacity applied)
+    and the bounding box they have to be placed at in the canvas.
+    """
+    def __init__(self, image:Image.Image = None, bbox:Tuple[int, int, int, int] = (0, 0, 0, 0)):
+        self.image:Image.Image = image
+        self.bbox:Tuple[int, int, int, int] = bbox
+
+    def isEmpty(self) -> bool:
+        return self.image is None
+
+    def byteSize(self) -> int:
+        if self.image is None:
+            return 0
+        return self.image.width * self.image.height * len(self.image.getbands())
+
+
+class RenderNode:
+    """
+    Static description of a layer as seen by the compositor. The visibility is
+    read from the layer itself when compositing, so it follows updateLayersVisibility.
+    """
+    def __init__(self, layer, node_path:str):
+        self.layer = layer
+        self.node_path:str = node_path
+        self.children:List['RenderNode'] = []
+        self.clips:List['RenderNode'] = []
+        # Whether the layer ends up blended with the normal mode, in which case blending
+        # it as part of an isolated composite gives the same result (see Compositor._isolable)
+        self.blendsNormally:bool = False
+        # Runs of static children by the index of their first one, see Compositor.setStaticLayers
+        self.slabs:Dict[int, 'Slab'] = {}
+
+    def isGroup(self) -> bool:
+        return self.layer.is_group()
+
+
+class Slab:
+    """
+    Run of sibling layers that every image of an export shows or hides alike. While
+    they have that visibility, they're composited once and blended as a single image.
+    """
+    def __init__(self, nodes:List[RenderNode], visibilityKey:str, bottomOnly:bool):
+        self.nodes:List[RenderNode] = nodes
+        self.path:str = 'slab:{0}-{1}'.format(nodes[0].node_path, nodes[-1].node_path)
+        self.visibilityKey:str = visibilityKey # See Compositor._stateKey
+        # Some layer doesn't blend normally, the slab only matches when composited on an empty canvas
+        self.bottomOnly:bool = bottomOnly
+
+
+class MemoryBudget:
+    """
+    Memory shared by all the caches of a process: the layer rasters, the group composites
+    and their reduced copies for the previews. The caches record their entries here, and
+    once all of them take more than maxBytes the least recently used entries are dropped,
+    whatever cache they belong to. A maxBytes of 0 means no limit.
+    """
+    def __init__(self, maxBytes:int = 0):
+        self.maxBytes:int = maxBytes
+        # (cache id, key) -> (cache, bytes), the least recently used first
+        self.entries:OrderedDict = OrderedDict()
+        self.bytes:int = 0
+        self.peakBytes:int = 0
+        self.evictions:int = 0
+        # The previews and the export may render at the same time
+        self.lock = threading.RLock()
+
+    def add(self, cache, key, size:int):
+        with self.lock:
+            old = self.entries.pop((id(cache), key), None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[(id(cache), key)] = (cache, size)
+            self.bytes += size
+            self.peakBytes = max(self.peakBytes, self.bytes)
+            self.evict()
+
+    def touch(self, cache, key):
+        with self.lock:
+            if (id(cache), key) in self.entries:
+                self.entries.move_to_end((id(cache), key))
+
+    def remove(self, cache, key):
+        with self.lock:
+            old = self.entries.pop((id(cache), key), None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def evict(self):
+        with self.lock:
+            while self.maxBytes > 0 and self.bytes > self.maxBytes and len(self.entries) > 0:
+                (_, key), (cache, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+                cache._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+
+
+class LayerRasterCache:
+    """
+    Rasterized pixels of the leaf layers keyed by node_path. Every layer gets decoded
+    and rasterized the first time it's needed and reused for all the following renders.
+    With a reduction factor the rasters are the ones of the source cache downsampled,
+    so a canvas composited from them is that many times smaller.
+    With a memory budget the rasters may get dropped, and are rasterized again when needed.
+    The rasters leave out the opacity of the layer, it's applied when they're blended.
+    """
+    def __init__(self, factor:int = 1, source:'LayerRasterCache' = None, budget:MemoryBudget = None):
+        self.factor:int = factor
+        self.source:LayerRasterCache = source
+        if factor > 1 and source is None:
+            self.source = LayerRasterCache(budget=budget)
+        self.budget:MemoryBudget = budget
+        self.rasters:Dict[str, LayerRaster] = {}
+        self.bytes:int = 0
+        self.hits:int = 0
+        self.misses:int = 0
+
+    def get(self, node:RenderNode) -> LayerRaster:
+        raster = self.rasters.get(node.node_path)
+        if raster is not None:
+            self.hits += 1
+            if self.budget is not None:
+                self.budget.touch(self, node.node_path)
+            return raster
+        self.misses += 1
+        if self.factor > 1:
+            raster = _reduce(self.source.get(node), self.factor)
+        else:
+            raster = self._rasterize(node.layer)
+        self.rasters[node.node_path] = raster
+        self.bytes += raster.byteSize()
+        if self.budget is not None:
+            self.budget.add(self, node.node_path, raster.byteSize())
+        return raster
+
+    def _drop(self, key:str):
+        # Called by the memory budget
+        raster = self.rasters.pop(key, None)
+        if raster is not None:
+            self.bytes -= raster.byteSize()
+
+    def clear(self):
+        if self.budget is not None:
+            for key in list(self.rasters.keys()):
+                self.budget.remove(self, key)
+        self.rasters = {}
+        self.bytes = 0
+
+    def _rasterize(self, layer) -> LayerRaster:
+        bbox = layer.bbox
+        if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            return LayerRaster()
+        # Only accept the layer itself, so it's rendered even if it's hidden right now
+        # and its clip layers are left out (they are rasterized on their own).
+        # psd-tools skips clip layers unless they come with their base, so they are
+        # flagged as regular layers for the duration of the render. The opacity is
+        # left out too: a base gets its clip layers before it's faded.
+        clipping = layer._record.clipping
+        opacity = layer._record.opacity
+        layer._record.clipping = Clipping.BASE
+        layer._record.opacity = 255
+        try:
+            image = layer.composite(viewport=bbox, force=True, layer_filter=lambda l: l is layer)
+        finally:
+            layer._record.clipping = clipping
+            layer._record.opacity = opacity
+        if image is None:
+            return LayerRaster()
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return LayerRaster(image, bbox)
+
+
+class GroupCompositeCache:
+    """
+    Isolated composites of groups keyed by the node_path of the group and the visibility
+    of everything inside it. A group whose layers weren't touched since an earlier render
+    is blended as a single image. The least recently used composites are dropped once
+    they take more than maxBytes, or earlier when the memory budget runs out.
+    """
+    def __init__(self, maxBytes:int = GROUP_CACHE_BYTES, budget:MemoryBudget = None):
+        self.maxBytes:int = maxBytes
+        self.budget:MemoryBudget = budget
+        self.entries:OrderedDict = OrderedDict()
+        self.bytes:int = 0
+        self.hits:int = 0
+        self.misses:int = 0
+
+    def get(self, key:Tuple[str, str]) -> LayerRaster:
+        raster = self.entries.get(key)
+        if raster is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if self.budget is not None:
+            self.budget.touch(self, key)
+        return raster
+
+    def put(self, key:Tuple[str, str], raster:LayerRaster):
+        size = raster.byteSize()
+        if size > self.maxBytes:
+            return
+        self._drop(key)
+        self.entries[key] = raster
+        self.bytes += size
+        while self.bytes > self.maxBytes:
+            evictedKey, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.byteSize()
+            if self.budget is not None:
+                self.budget.remove(self, evictedKey)
+        if self.budget is not None:
+            self.budget.add(self, key, size)
+
+    def _drop(self, key:Tuple[str, str]):
+        # Also called by the memory budget
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.byteSize()
+
+    def clear(self):
+        if self.budget is not None:
+            for key in list(self.entries.keys()):
+                self.budget.remove(self, key)
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+
+class Compositor:
+    """
+    Composites a PSD from the rasters of its layers, so once a layer has been
+    rasterized the following renders only pay for blending it.
+    """
+    def __init__(self, psd:PSDImage, rasters:LayerRasterCache = None, groups:GroupCompositeCache = None,
+            staticLayers:Dict[str, bool] = None):
+        self.psd = psd
+        self.rasters = rasters if rasters is not None else LayerRasterCache()
+        self.groups = groups if groups is not None else GroupCompositeCache()
+        self.nodes:List[RenderNode] = self._buildNodes(psd, '')
+        # Every node, clip layers included, to find the ones toggled since the last composite
+        self.allNodes:List[RenderNode] = []
+        self._flattenNodes(self.nodes)
+        self.slabs:Dict[int, Slab] = {} # Of the top level layers
+        # Set by setStaticLayers, possibly from another thread than the one compositing
+        self._pendingStaticLayers:Dict[str, bool] = None
+        self._staticLock = threading.Lock()
+        self._applyStaticLayers(staticLayers or {})
+        self._extents:Dict[str, Tuple[int, int, int, int]] = {}
+        self._lastComposite:Image.Image = None
+        self._lastVisibility:List[bool] = None
+        # Visibility of the descendants of every group in the render going on, by node_path
+        self._visibilityKeys:Dict[str, str] = {}
+        self._isCancelled:Callable[[], bool] = None
+
+    @staticmethod
+    def isSupported(psd:PSDImage) -> bool:
+        """
+        Check whether the document only uses features this compositor can reproduce.
+        Adjustment layers and masks or effects on groups are left to psd-tools.
+        """
+        if psd.color_mode != ColorMode.RGB or psd.depth != 8:
+            return False
+        for layer in psd.descendants():
+            if isinstance(layer, AdjustmentLayer):
+                return False
+            if layer.is_group() and (layer.has_mask() or layer.has_effects()):
+                return False
+        return True
+
+    def _buildNodes(self, parent, parent_path:str) -> List[RenderNode]:
+        nodes = []
+        clipped = set()
+        layers = list(parent)
+        for i in range(len(layers)):
+            layer = layers[i]
+            if id(layer) in clipped:
+                # Newer psd-tools releases also list the clip layers along their base
+                continue
+            node_path = str(i) if not parent_path else parent_path + '.' + str(i)
+            node = RenderNode(layer, node_path)
+            clips = list(getattr(layer, 'clip_layers', None) or [])
+            for j in range(len(clips)):
+                clipped.add(id(clips[j]))
+                node.clips.append(RenderNode(clips[j], node_path + '.' + CLIP_LAYER_PATH + '.' + str(j)))
+            if layer.is_group():
+                node.children = self._buildNodes(layer, node_path)
+            if layer.blend_mode == BlendMode.PASS_THROUGH:
+                node.blendsNormally = all(c.blendsNormally for c in node.children)
+            else:
+                node.blendsNormally = layer.blend_mode == BlendMode.NORMAL
+            nodes.append(node)
+        return nodes
+
+    def _flattenNodes(self, nodes:List[RenderNode]):
+        for node in nodes:
+            self.allNodes.append(node)
+            self._flattenNodes(node.clips)
+            self._flattenNodes(node.children)
+
+    def setStaticLayers(self, staticLayers:Dict[str, bool]):
+        """
+        Set the layers whose visibility is the same in every image of an export, by node path
+        with that visibility. Runs of them are composited once into slabs, which the canvas
+        and the groups blend in place of the layers. A run starting at the bottom of a canvas
+        can hold any blend mode, the others only layers blending normally. A slab is only used
+        while its layers have the given visibility, any other state is still composited right.
+        The slabs change with the next composite, so a render going on isn't disturbed.
+        """
+        with self._staticLock:
+            self._pendingStaticLayers = staticLayers
+
+    def _applyStaticLayers(self, staticLayers:Dict[str, bool]):
+        self.slabs = self._findSlabs(self.nodes, staticLayers)
+        for node in self.allNodes:
+            node.slabs = self._findSlabs(node.children, staticLayers) if node.isGroup() else {}
+
+    def _isStatic(self, node:RenderNode, staticLayers:Dict[str, bool]) -> bool:
+        if node.node_path not in staticLayers:
+            return False
+        if not staticLayers[node.node_path]:
+            # What's inside a hidden layer doesn't matter
+            return True
+        return all(self._isStatic(n, staticLayers) for n in node.clips + node.children)
+
+    def _findSlabs(self, nodes:List[RenderNode], staticLayers:Dict[str, bool]) -> Dict[int, Slab]:
+        slabs = {}
+        start = 0
+        bottom = True
+        for end in range(len(nodes) + 1):
+            if end < len(nodes):
+                node = nodes[end]
+                if self._isStatic(node, staticLayers) and (bottom or not staticLayers[node.node_path] or node.blendsNormally):
+                    continue
+            run = nodes[start:end]
+            visible = [n for n in run if staticLayers[n.node_path]]
+            if len(visible) >= SLAB_MIN_LAYERS:
+                key = self._stateKey(run, lambda n: staticLayers[n.node_path])
+                slabs[start] = Slab(run, key, not all(n.blendsNormally for n in visible))
+            start = end + 1
+            bottom = False
+        return slabs
+
+    @staticmethod
+    def _stateKey(nodes:List[RenderNode], isVisible:Callable[[RenderNode], bool]) -> str:
+        """
+        Visibility of some layers and of everything inside the visible ones
+        """
+        parts = []
+        for node in nodes:
+            if not isVisible(node):
+                parts.append('0')
+                continue
+            parts.append('1')
+            if len(node.clips) > 0:
+                parts.append('[' + Compositor._stateKey(node.clips, isVisible) + ']')
+            if node.isGroup():
+                parts.append('(' + Compositor._stateKey(node.children, isVisible) + ')')
+        return ''.join(parts)
+
+    def size(self) -> Tuple[int, int]:
+        """
+        Size of the composite, the size of the PSD divided by the reduction factor of the rasters
+        """
+        factor = self.rasters.factor
+        return (-(-self.psd.width // factor), -(-self.psd.height // factor))
+
+    def composite(self, isCancelled:Callable[[], bool] = None) -> Image.Image:
+        """
+        Composite the visible layers. Only the region covered by the layers toggled since
+        the previous composite is composited again, the rest is copied from it. The returned
+        image is reused that way, so it must not be modified.
+        isCancelled is checked before every layer and RenderCancelled raised once it returns
+        True, nothing half done gets cached.
+        """
+        with self._staticLock:
+            staticLayers, self._pendingStaticLayers = self._pendingStaticLayers, None
+        if staticLayers is not None:
+            self._applyStaticLayers(staticLayers)
+        visibility = [n.layer.visible for n in self.allNodes]
+        self._visibilityKeys = {}
+        self._isCancelled = isCancelled
+        try:
+            region = self._dirtyRegion(visibility)
+            if region is None:
+                canvas = Image.new('RGBA', self.size(), (0, 0, 0, 0))
+                self._compositeNodes(canvas, (0, 0), self.nodes, self.slabs, True)
+            elif region[2] <= region[0] or region[3] <= region[1]:
+                # Nothing changed
+                canvas = self._lastComposite
+            else:
+                # Composite everything on a canvas that only covers the region, the pixels come out
+                # exactly as in a full composite as all the blending happens pixel by pixel
+                regionCanvas = Image.new('RGBA', (region[2] - region[0], region[3] - region[1]), (0, 0, 0, 0))
+                self._compositeNodes(regionCanvas, (region[0], region[1]), self.nodes, self.slabs, True)
+                canvas = self._lastComposite.copy()
+                canvas.paste(regionCanvas, (region[0], region[1]))
+        finally:
+            self._isCancelled = None
+        self._lastComposite = canvas
+        self._lastVisibility = visibility
+        return canvas
+
+    def _dirtyRegion(self, visibility:List[bool]) -> Tuple[int, int, int, int]:
+        """
+        Union of the extents of the layers toggled since the last composite,
+        or None when everything has to be composited
+        """
+        if self._lastComposite is None:
+            return None
+        region = (0, 0, 0, 0)
+        for i in range(len(visibility)):
+            if visibility[i] == self._lastVisibility[i]:
+                continue
+            extent = self._extentOf(self.allNodes[i])
+            if extent is not None:
+                region = extent if region[2] <= region[0] else _union(region, extent)
+        width, height = self.size()
+        region = (max(region[0], 0), max(region[1], 0), min(region[2], width), min(region[3], height))
+        area = max(region[2] - region[0], 0) * max(region[3] - region[1], 0)
+        if area > DIRTY_REGION_MAX_SHARE * width * height:
+            return None
+        return region
+
+    def _extentOf(self, node:RenderNode) -> Tuple[int, int, int, int]:
+        """
+        Area a layer can paint on, whatever the visibility of the layers in it.
+        Clip layers never paint outside of their base.
+        """
+        if node.node_path in self._extents:
+            return self._extents[node.node_path]
+        extent = None
+        if node.isGroup():
+            for child in node.children:
+                bbox = self._extentOf(child)
+                if bbox is not None:
+                    extent = bbox if extent is None else _union(extent, bbox)
+        else:
+            bbox = node.layer.bbox
+            if bbox[2] > bbox[0] and bbox[3] > bbox[1]:
+                extent = _reduceBBox(bbox, self.rasters.factor)
+        self._extents[node.node_path] = extent
+        return extent
+
+    def _visibilityKey(self, node:RenderNode) -> str:
+        """
+        Visibility flags of all the layers inside a group, in the order they are composited
+        """
+        key = self._visibilityKeys.get(node.node_path)
+        if key is None:
+            parts = []
+            for child in node.children:
+                parts.append('1' if child.layer.visible else '0')
+                for clip in child.clips:
+                    parts.append('1' if clip.layer.visible else '0')
+                    if clip.isGroup():
+                        parts.append('(' + self._visibilityKey(clip) + ')')
+                if child.isGroup():
+                    parts.append('(' + self._visibilityKey(child) + ')')
+            key = ''.join(parts)
+            self._visibilityKeys[node.node_path] = key
+        return key
+
+    @staticmethod
+    def _isolable(node:RenderNode) -> bool:
+        """
+        A pass-through group can be composited on its own and then blended as a whole
+        when all its layers blend normally, as source-over doesn't depend on grouping.
+        """
+        return node.blendsNormally and len(node.children) > 0
+
+    def _compositeNodes(self, canvas:Image.Image, origin:Tuple[int, int], nodes:List[RenderNode],
+            slabs:Dict[int, Slab] = None, empty:bool = False):
+        """
+        Composite the layers on the canvas, empty tells whether nothing was blended on it yet
+        """
+        slabEnd = 0
+        for i in range(len(nodes)):
+            if i < slabEnd:
+                continue
+            node = nodes[i]
+            if self._isCancelled is not None and self._isCancelled():
+                raise RenderCancelled()
+            slab = slabs.get(i) if slabs is not None else None
+            if slab is not None and (not slab.bottomOnly or (i == 0 and empty)) \
+                    and self._stateKey(slab.nodes, lambda n: n.layer.visible) == slab.visibilityKey:
+                _blend(canvas, origin, self._slabRaster(slab), BlendMode.NORMAL)
+                slabEnd = i + len(slab.nodes)
+                continue
+            if not node.layer.visible:
+                continue
+            visibleClips = [c for c in node.clips if c.layer.visible]
+            if node.isGroup():
+                if not visibleClips and node.layer.blend_mode == BlendMode.PASS_THROUGH and not self._isolable(node):
+                    # The children have to blend with the backdrop, composite them directly
+                    if node.layer.opacity == 255:
+                        self._compositeNodes(canvas, origin, node.children, node.slabs)
+                    else:
+                        self._compositePassThrough(canvas, origin, node)
+                    continue
+                raster = self._isolate(node)
+            else:
+                raster = self.rasters.get(node)
+            if len(visibleClips) > 0:
+                raster = self._clipGroup(raster, visibleClips)
+            _blend(canvas, origin, raster, _blendModeOf(node.layer), node.layer.opacity)
+
+    def _compositePassThrough(self, canvas:Image.Image, origin:Tuple[int, int], node:RenderNode):
+        """
+        Composite the children of a faded pass-through group with the layers below them,
+        then interpolate between the backdrop and the result by the opacity of the group
+        """
+        extent = self._visibleExtent(node.children)
+        if extent is None:
+            return
+        box = (max(extent[0], origin[0]), max(extent[1], origin[1]),
+               min(extent[2], origin[0] + canvas.width), min(extent[3], origin[1] + canvas.height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return
+        # The children can't change the backdrop outside of their extent
+        relative = _relative(box, origin)
+        backdrop = canvas.crop(relative)
+        result = backdrop.copy()
+        self._compositeNodes(result, (box[0], box[1]), node.children, node.slabs)
+        canvas.paste(_interpolate(backdrop, result, node.layer.opacity), (relative[0], relative[1]))
+
+    def _slabRaster(self, slab:Slab) -> LayerRaster:
+        """
+        Composite of the layers of a slab on a transparent canvas, reused while it's cached
+        """
+        key = (slab.path, slab.visibilityKey)
+        raster = self.groups.get(key)
+        if raster is None:
+            bbox = self._visibleExtent(slab.nodes)
+            if bbox is None:
+                raster = LayerRaster()
+            else:
+                slabCanvas = Image.new('RGBA', (bbox[2] - bbox[0], bbox[3] - bbox[1]), (0, 0, 0, 0))
+                self._compositeNodes(slabCanvas, (bbox[0], bbox[1]), slab.nodes, None, True)
+                raster = LayerRaster(slabCanvas, bbox)
+            self.groups.put(key, raster)
+        return raster
+
+    def _clipGroup(self, base:LayerRaster, clips:List[RenderNode]) -> LayerRaster:
+        """
+        Composite the clip layers over the base, the result keeps the transparency
+        of the base and gets blended with the blend mode and the opacity of the base:
+        the clipping group is faded as a whole.
+        """
+        if base.isEmpty():
+            return base
+        image = base.image.copy()
+        alpha = image.getchannel('A')
+        for clip in clips:
+            clipRaster = self._isolate(clip) if clip.isGroup() else self.rasters.get(clip)
+            _blend(image, (base.bbox[0], base.bbox[1]), clipRaster, _blendModeOf(clip.layer), clip.layer.opacity)
+        image.putalpha(alpha)
+        return LayerRaster(image, base.bbox)
+
+    def _isolate(self, node:RenderNode) -> LayerRaster:
+        """
+        Composite the children of a group on their own transparent canvas,
+        just big enough to hold the visible ones, or reuse the previous composite
+        if the visibility of its layers hasn't changed.
+        """
+        key = (node.node_path, self._visibilityKey(node))
+        raster = self.groups.get(key)
+        if raster is None:
+            raster = self._compositeGroup(node)
+            self.groups.put(key, raster)
+        return raster
+
+    def _compositeGroup(self, node:RenderNode) -> LayerRaster:
+        bbox = self._visibleExtent(node.children)
+        if bbox is None:
+            return LayerRaster()
+        groupCanvas = Image.new('RGBA', (bbox[2] - bbox[0], bbox[3] - bbox[1]), (0, 0, 0, 0))
+        self._compositeNodes(groupCanvas, (bbox[0], bbox[1]), node.children, node.slabs, True)
+        # Without the opacity of the group, like the layer rasters
+        return LayerRaster(groupCanvas, bbox)
+
+    def _visibleExtent(self, nodes:List[RenderNode]) -> Tuple[int, int, int, int]:
+        """
+        Union of the bboxes of the visible layers, clip layers are always inside their base
+        """
+        extent = None
+        for node in nodes:
+            if not node.layer.visible:
+                continue
+            if node.isGroup():
+                bbox = self._visibleExtent(node.children)
+            else:
+                raster = self.rasters.get(node)
+                bbox = None if raster.isEmpty() else raster.bbox
+            if bbox is not None:
+                extent = bbox if extent is None else _union(extent, bbox)
+        return extent
+
+
+def _relative(bbox:Tuple[int, int, int, int], origin:Tuple[int, ...]) -> Tuple[int, int, int, int]:
+    return (bbox[0] - origin[0], bbox[1] - origin[1], bbox[2] - origin[0], bbox[3] - origin[1])
+
+def _blendModeOf(layer) -> BlendMode:
+    # An isolated pass-through group blends like a normal layer
+    if layer.blend_mode == BlendMode.PASS_THROUGH:
+        return BlendMode.NORMAL
+    return layer.blend_mode
+
+def _union(a:Tuple[int, int, int, int], b:Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _reduceBBox(bbox:Tuple[int, int, int, int], factor:int) -> Tuple[int, int, int, int]:
+    # Every reduced pixel the bbox touches
+    return (bbox[0] // factor, bbox[1] // factor, -(-bbox[2] // factor), -(-bbox[3] // factor))
+
+def _reduce(raster:LayerRaster, factor:int) -> LayerRaster:
+    """
+    Downsample a raster by an integer factor. The raster is padded to the pixel grid
+    of the reduced canvas first, so every reduced pixel averages the same source
+    pixels it would if the whole canvas was reduced.
+    """
+    if raster.isEmpty():
+        return raster
+    l, t = raster.bbox[0], raster.bbox[1]
+    bbox = _reduceBBox(raster.bbox, factor)
+    image = raster.image
+    padded = (bbox[0] * factor, bbox[1] * factor, bbox[2] * factor, bbox[3] * factor)
+    if padded != raster.bbox:
+        image = Image.new('RGBA', (padded[2] - padded[0], padded[3] - padded[1]), (0, 0, 0, 0))
+        image.paste(raster.image, (l - padded[0], t - padded[1]))
+    return LayerRaster(image.reduce(factor), bbox)
+
+def _interpolate(backdrop:Image.Image, result:Image.Image, opacity:int) -> Image.Image:
+    """
+    Fade the result back to the backdrop by the opacity, in premultiplied space so the
+    color of transparent pixels doesn't bleed in
+    """
+    b = np.asarray(backdrop, dtype=np.float32) / 255.0
+    r = np.asarray(result, dtype=np.float32) / 255.0
+    t = opacity / 255.0
+    ab, ar = b[..., 3:], r[..., 3:]
+    ao = (1.0 - t) * ab + t * ar
+    premultiplied = (1.0 - t) * ab * b[..., :3] + t * ar * r[..., :3]
+    Co = np.divide(premultiplied, ao, out=np.zeros_like(premultiplied), where=ao > 0)
+    out = np.concatenate((Co, ao), axis=2)
+    return Image.fromarray(np.round(out * 255.0).astype(np.uint8), 'RGBA')
+
+def _blend(canvas:Image.Image, origin:Tuple[int, int], raster:LayerRaster, blendMode:BlendMode, opacity:int = 255):
+    """
+    Blend the raster onto the canvas, whose top left corner is at origin, faded by the opacity
+    """
+    if raster is None or raster.isEmpty():
+        return
+    # Only the part of the raster that falls inside the canvas
+    left = max(raster.bbox[0], origin[0])
+    top = max(raster.bbox[1], origin[1])
+    right = min(raster.bbox[2], origin[0] + canvas.width)
+    bottom = min(raster.bbox[3], origin[1] + canvas.height)
+    if right <= left or bottom <= top:
+        return
+    bbox = (left, top, right, bottom)
+    source = raster.image
+    if bbox != raster.bbox:
+        source = source.crop(_relative(bbox, raster.bbox))
+    if opacity < 255:
+        faded = source.getchannel('A').point(lambda a: (a * opacity + 127) // 255)
+        source = source.copy()
+        source.putalpha(faded)
+    box = _relative(bbox, (origin[0], origin[1]))
+    func = BLEND_FUNC.get(blendMode)
+    if func is None or blendMode in (BlendMode.NORMAL, BlendMode.PASS_THROUGH):
+        canvas.alpha_composite(source, dest=(box[0], box[1]))
+        return
+    backdrop = np.asarray(canvas.crop(box), dtype=np.float32) / 255.0
+    src = np.asarray(source, dtype=np.float32) / 255.0
+    Cb, ab = backdrop[..., :3], backdrop[..., 3:]
+    Cs, as_ = src[..., :3], src[..., 3:]
+    # Blend the source with the backdrop where there is one, then do a source-over
+    blended = np.clip(func(Cb, Cs), 0.0, 1.0)
+    Cs = (1.0 - ab) * Cs + ab * blended
+    ao = as_ + ab * (1.0 - as_)
+    Co = np.divide(as_ * Cs + (1.0 - as_) * ab * Cb, ao, out=np.zeros_like(Cs), where=ao > 0)
+    result = np.concatenate((Co, ao), axis=2)
+    canvas.paste(Image.fromarray(np.round(result * 255.0).astype(np.uint8), 'RGBA'), (box[0], box[1]))
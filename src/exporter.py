@@ -0,0 +1,580 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app import App
+from models import Modifier, ModifierCombination, Variation, OutputFormat, FORMAT_PNG
+from rendercache import RenderCache
+import tracing
+import utils
+
+MANIFEST_FILENAME = '.export_manifest.json'
+# The files recorded since the manifest was last saved, one JSON line per file
+MANIFEST_JOURNAL_FILENAME = '.export_manifest.log'
+
+class ExportJob:
+    """
+    A single image to export: a variation, the modifiers linked to it and
+    the combination of those modifiers to apply.
+    """
+    def __init__(self, variationIndex:int, variation:Variation, modifiers:List[Modifier],
+            combination:ModifierCombination, fname:str, outputFormat:OutputFormat = None):
+        self.variationIndex:int = variationIndex
+        self.variation:Variation = variation
+        self.modifiers:List[Modifier] = modifiers
+        self.combination:ModifierCombination = combination
+        self.fname:str = fname
+        self.outputFormat:OutputFormat = outputFormat if outputFormat is not None else OutputFormat()
+        # Identifies the content of the output file, see outputFingerprint
+        self.outputFingerprint:str = None
+        # Key of the full size render in the render cache, set by renderJob
+        self.renderCacheKey:str = None
+        # Final state of the layers (indexed like the layer table) and its fingerprint, see computeStates
+        self.visibility:np.ndarray = None
+        self.fingerprint:str = None
+
+    def __repr__(self) -> str:
+        return '<ExportJob variation="{0}", bitflags="{1}", fname="{2}">'.format(
+            self.variation.name, self.combination.bitflags, self.fname)
+
+
+class RenderGroup:
+    """
+    Jobs that end up with the exact same layer visibility. Only the first one
+    is rendered, the other files are links or copies of it.
+    """
+    def __init__(self, job:ExportJob):
+        self.job:ExportJob = job
+        self.duplicates:List[ExportJob] = []
+
+    def fnames(self) -> List[str]:
+        return [self.job.fname] + [d.fname for d in self.duplicates]
+
+
+class ExportSummary:
+    def __init__(self) -> None:
+        self.images:int = 0
+        self.renders:int = 0
+        self.skipped:int = 0 # Up to date files from a previous export
+        self.ellapsed:float = 0.0
+        self.peakRSS:int = None # Bytes, of this process
+        self.workersPeakRSS:int = None # Bytes, of the largest worker process
+        self.caches:Dict[str, Dict[str, int]] = {} # See App.cacheStats, added up over all the processes
+
+    def rendersSaved(self) -> int:
+        return self.images - self.skipped - self.renders
+
+    def hitRate(self, cache:str) -> float:
+        stats = self.caches.get(cache, {})
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        return stats.get('hits', 0) / lookups if lookups > 0 else None
+
+    def __repr__(self) -> str:
+        return '<ExportSummary images={0}, renders={1}, skipped={2}, ellapsed={3}>'.format(
+            self.images, self.renders, self.skipped, self.ellapsed)
+
+
+class ExportManifest:
+    """
+    Record of the files an export wrote into an output folder and the fingerprint of
+    their content. The next export recognises them as its own outputs, so they keep
+    their names, and skips the ones that are still up to date. Every file is appended to
+    a journal once it's in place, so an export killed at any point resumes where it
+    stopped. save folds the journal into the manifest. The layers of the last complete
+    export are kept too, to tell what changed in the PSD since then.
+    """
+    def __init__(self, baseOutDir:str):
+        self.baseOutDir:str = baseOutDir
+        self.path:str = os.path.join(baseOutDir, MANIFEST_FILENAME)
+        self.journalPath:str = os.path.join(baseOutDir, MANIFEST_JOURNAL_FILENAME)
+        self.files:Dict[str, str] = {} # Fingerprints by path relative to the output folder
+        self.layers:Dict[str, Dict[str, str]] = None # Name and content hash by node path
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, baseOutDir:str) -> 'ExportManifest':
+        inst = ExportManifest(baseOutDir)
+        if os.path.isfile(inst.path):
+            try:
+                with open(inst.path, 'rt') as fp:
+                    d = json.load(fp)
+                inst.files = d.get('files', {})
+                inst.layers = d.get('layers')
+            except (OSError, ValueError) as e:
+                print('WARN: Ignoring the unreadable export manifest {0}: {1}'.format(inst.path, e))
+        if os.path.isfile(inst.journalPath):
+            # Left by an export that didn't finish
+            with open(inst.journalPath, 'rt') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a killed export can be cut short
+                        continue
+                    inst.files[entry['file']] = entry['fingerprint']
+        return inst
+
+    def _key(self, fname:str) -> str:
+        return os.path.relpath(fname, self.baseOutDir).replace(os.sep, '/')
+
+    def ownedFiles(self) -> Set[str]:
+        """
+        Returns the paths of the files written by previous exports
+        """
+        return set(os.path.normpath(os.path.join(self.baseOutDir, k)) for k in self.files.keys())
+
+    def isUpToDate(self, fname:str, fingerprint:str) -> bool:
+        return self.files.get(self._key(fname)) == fingerprint and os.path.isfile(fname)
+
+    def claim(self, fnames:List[str]):
+        """
+        Own the files about to be written, with no fingerprint until they're recorded. A file
+        put in place right before the export got killed keeps its name when it resumes.
+        """
+        with self.lock:
+            for fname in fnames:
+                self.files[self._key(fname)] = None
+            self._journal([self._key(f) for f in fnames])
+
+    def record(self, fname:str, fingerprint:str):
+        """
+        Record a file once it's in place under its final name
+        """
+        key = self._key(fname)
+        with self.lock:
+            self.files[key] = fingerprint
+            self._journal([key])
+
+    def _journal(self, keys:List[str]):
+        # Called with the lock held
+        with open(self.journalPath, 'at') as fp:
+            for key in keys:
+                fp.write(json.dumps({'file': key, 'fingerprint': self.files[key]}) + '\n')
+
+    def recordLayers(self, app:App):
+        table = app.getLayerTable()
+        hashes = app.getLayerHashes()
+        with self.lock:
+            self.layers = {p: {'name': table.labels[i], 'hash': hashes[p]} for i, p in enumerate(table.node_paths)}
+
+    def changedLayers(self, app:App) -> List[str]:
+        """
+        Names of the layers added, removed, renamed or with another content since the last
+        complete export, or None when there was none
+        """
+        if self.layers is None:
+            return None
+        table = app.getLayerTable()
+        hashes = app.getLayerHashes()
+        changed = []
+        for i, p in enumerate(table.node_paths):
+            previous = self.layers.get(p)
+            if previous is None or previous['name'] != table.labels[i] or previous['hash'] != hashes[p]:
+                changed.append(table.labels[i])
+        changed.extend(d['name'] for p, d in self.layers.items() if p not in table.ids)
+        return changed
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wt') as fp:
+            json.dump({'files': self.files, 'layers': self.layers}, fp, indent=1, sort_keys=True)
+        os.replace(tmpPath, self.path)
+        if os.path.isfile(self.journalPath):
+            os.remove(self.journalPath)
+
+
+class ImageWriter:
+    """
+    Encodes and writes the rendered images on a pool of threads, so the next image gets
+    composited meanwhile. The queue is bounded: once it's full the render waits for a writer
+    to catch up, which caps the number of images held in memory. With no threads the images
+    are written right away by put.
+    """
+    def __init__(self, threads:int = 2, queueSize:int = 2, onExported:Callable[[str], None] = None,
+            cache:RenderCache = None):
+        self.queue:queue.Queue = queue.Queue(maxsize=max(queueSize, 1))
+        self.onExported = onExported
+        self.cache:RenderCache = cache
+        # Serializes the onExported calls and guards the errors
+        self.lock = threading.Lock()
+        self.errors:List[BaseException] = []
+        self.threads:List[threading.Thread] = []
+        for i in range(threads):
+            t = threading.Thread(target=self._run, name='ImageWriter-{0}'.format(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, image:Image.Image, group:RenderGroup):
+        """
+        Queue the image of a group, blocks while the queue is full. Raises the first
+        error of the writers, if any, so the export stops.
+        """
+        self._raiseErrors()
+        if len(self.threads) == 0:
+            self._write(image, group)
+        else:
+            self.queue.put((image, group))
+
+    def close(self):
+        """
+        Wait for all the queued images to be written
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self._raiseErrors()
+
+    def _raiseErrors(self):
+        with self.lock:
+            if len(self.errors) > 0:
+                raise self.errors[0]
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+    def _write(self, image:Image.Image, group:RenderGroup):
+        fnames = writeGroup(image, group, self.cache)
+        if self.onExported is not None:
+            with self.lock:
+                for fname in fnames:
+                    self.onExported(fname)
+
+
+def planExport(app:App, baseOutDir:str, manifest:ExportManifest = None) -> List[ExportJob]:
+    """
+    Build the list of images to export for every variation and its combinations of
+    modifiers. The output folders are created and the file names reserved up front,
+    so the jobs can be rendered in any order. The files listed in the manifest
+    are outputs of a previous export and get overwritten instead of renamed.
+    """
+    baseFileName = os.path.basename(app.originalPSDFilePath)
+    baseFileName = baseFileName[0:baseFileName.rfind('.')]
+    reserved = set()
+    owned = manifest.ownedFiles() if manifest is not None else None
+    jobs:List[ExportJob] = []
+    for i in range(len(app.variations)):
+        v = app.variations[i]
+        outDir = baseOutDir
+        if len(v.subfolder) > 0:
+            outDir = os.path.join(baseOutDir, v.subfolder)
+        os.makedirs(outDir, exist_ok=True)
+        mods = app.lookupVariationModifiers(v)
+        outputFormat = app.outputFormatFor(v)
+        combs = v.combinations
+        if len(mods) == 0:
+            # There are no modifiers, export the variation alone
+            combs = [ModifierCombination.from_dict({'name': '<Empty>', 'bitflags': '0'})]
+        elif len(combs) == 0:
+            combs = utils.defaultCombinations(v, mods)
+        for c in combs:
+            suffix = utils.getSuffixFor(v, app.modifiersToApply(mods, c.bitflags))
+            fname = utils.getUniqueFilename(outDir, baseFileName + suffix, outputFormat.extension(), reserved, owned)
+            jobs.append(ExportJob(i, v, mods, c, fname, outputFormat))
+    return jobs
+
+def imageCount(app:App) -> int:
+    """
+    Number of images planExport will plan, without reserving any file
+    """
+    count = 0
+    for v in app.variations:
+        mods = app.lookupVariationModifiers(v)
+        if len(mods) == 0:
+            count += 1
+        elif len(v.combinations) > 0:
+            count += len(v.combinations)
+        else:
+            count += len(utils.defaultCombinations(v, mods))
+    return count
+
+def computeStates(app:App, jobs:List[ExportJob]):
+    """
+    Apply the variation and modifiers of every job, without touching the layers,
+    and fingerprint the resulting visibility.
+    """
+    table = app.getLayerTable()
+    variationStates:Dict[int, np.ndarray] = {}
+    for job in jobs:
+        with tracing.tags(variation=job.variation.name, combination=job.combination.bitflags):
+            if job.variationIndex not in variationStates:
+                variationStates[job.variationIndex] = app.variationVisibility(job.variation)
+            visibility = variationStates[job.variationIndex]
+            job.visibility = app.modifiersVisibility(job.modifiers, job.combination.bitflags, visibility)
+        job.fingerprint = table.fingerprint(job.visibility)
+
+def outputFingerprint(contentFingerprint:str, job:ExportJob) -> str:
+    """
+    Fingerprint of the content of the output file of a job: the layers its final state
+    shows (see App.contentFingerprint) and the encoder settings. Saving the PSD with
+    changes to layers the job hides leaves it the same.
+    """
+    encoder = json.dumps(job.outputFormat.to_dict(), sort_keys=True)
+    return hashlib.sha1((contentFingerprint + encoder).encode('utf-8')).hexdigest()
+
+def groupJobs(jobs:List[ExportJob]) -> List[RenderGroup]:
+    """
+    Group the jobs by their final visibility, so every distinct state gets rendered once
+    """
+    groups:Dict[str, RenderGroup] = {}
+    for job in jobs:
+        group = groups.get(job.fingerprint)
+        if group is None:
+            groups[job.fingerprint] = RenderGroup(job)
+        else:
+            group.duplicates.append(job)
+    return list(groups.values())
+
+def _hammingDistance(a:str, b:str) -> int:
+    return bin(int(a or '0', 2) ^ int(b or '0', 2)).count('1')
+
+def scheduleGroups(groups:List[RenderGroup]) -> List[RenderGroup]:
+    """
+    Order the renders of every variation so consecutive ones toggle as few modifiers
+    as possible (a Gray code when all the combinations are exported). The layers that
+    keep their visibility aren't touched between two images, which keeps the compositing
+    caches warm. The variations keep their order.
+    """
+    byVariation:Dict[int, List[RenderGroup]] = {}
+    for g in groups:
+        byVariation.setdefault(g.job.variationIndex, []).append(g)
+    scheduled = []
+    for variationIndex in sorted(byVariation.keys()):
+        pending = byVariation[variationIndex]
+        # Start from the combination closest to the plain variation
+        current = min(pending, key=lambda g: _hammingDistance(g.job.combination.bitflags, ''))
+        while True:
+            pending.remove(current)
+            scheduled.append(current)
+            if len(pending) == 0:
+                break
+            flags = current.job.combination.bitflags
+            current = min(pending, key=lambda g: _hammingDistance(g.job.combination.bitflags, flags))
+    return scheduled
+
+def renderJob(app:App, job:ExportJob) -> Image.Image:
+    """
+    Apply the state of a job on the layers and render it
+    """
+    if job.visibility is None:
+        computeStates(app, [job])
+    with tracing.tags(variation=job.variation.name, combination=job.combination.bitflags):
+        app.applyVisibility(job.visibility)
+        if app.getRenderCache() is not None:
+            job.renderCacheKey = app.renderCacheKey(app.psd.size)
+        return app.renderPSD()
+
+def writeGroup(image:Image.Image, group:RenderGroup, cache:RenderCache = None) -> List[str]:
+    """
+    Save the image of the first job of the group and link the rest of the files to it.
+    Files with other output settings are encoded again from the same image. The first
+    PNG file is copied into the render cache.
+    """
+    written:List[ExportJob] = []
+    for job in [group.job] + group.duplicates:
+        with tracing.tags(variation=job.variation.name, combination=job.combination.bitflags, file=os.path.basename(job.fname)):
+            same = [w for w in written if w.outputFormat.to_dict() == job.outputFormat.to_dict()]
+            if len(same) > 0:
+                with tracing.span(tracing.SPAN_WRITE, link=True):
+                    utils.linkOrCopy(same[0].fname, job.fname)
+            else:
+                utils.saveImage(image, job.fname, job.outputFormat)
+                written.append(job)
+    pngs = [w for w in written if w.outputFormat.format == FORMAT_PNG]
+    if cache is not None and group.job.renderCacheKey is not None and len(pngs) > 0:
+        cache.putFile(group.job.renderCacheKey, pngs[0].fname)
+    return group.fnames()
+
+def exportGroup(app:App, group:RenderGroup) -> List[str]:
+    """
+    Render the first job of the group and link the rest of the files to it
+    """
+    imageStart = time.time()
+    fnames = writeGroup(renderJob(app, group.job), group, app.getRenderCache())
+    print('Image exported in {0} seconds'.format(time.time() - imageStart))
+    return fnames
+
+def runExport(app:App, jobs:List[ExportJob], workers:int = 1, onExported:Callable[[str], None] = None,
+        manifest:ExportManifest = None, force:bool = False) -> ExportSummary:
+    """
+    Export all the jobs, either on this thread or spread across a pool of processes
+    that load the PSD once each. Jobs with the same final visibility are rendered once.
+    With a manifest the files still up to date are skipped, unless force is set, the other
+    ones are claimed in it before rendering and recorded once written. onExported is called with every file name once it's
+    written or skipped.
+    """
+    totalStart = time.time()
+    computeStates(app, jobs)
+    pending = jobs
+    if manifest is not None:
+        contents:Dict[str, str] = {} # By visibility fingerprint
+        for job in jobs:
+            if job.fingerprint not in contents:
+                contents[job.fingerprint] = app.contentFingerprint(job.visibility)
+            job.outputFingerprint = outputFingerprint(contents[job.fingerprint], job)
+        if not force:
+            pending = [j for j in jobs if not manifest.isUpToDate(j.fname, j.outputFingerprint)]
+        manifest.claim([j.fname for j in pending])
+    fingerprints = {j.fname: j.outputFingerprint for j in jobs}
+    def exported(fname:str):
+        if manifest is not None:
+            manifest.record(fname, fingerprints[fname])
+        if onExported is not None:
+            onExported(fname)
+    if onExported is not None and len(pending) < len(jobs):
+        pendingFnames = set(j.fname for j in pending)
+        for job in jobs:
+            if job.fname not in pendingFnames:
+                onExported(job.fname)
+    groups = scheduleGroups(groupJobs(pending))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(groups))
+    workerStats:List[Dict] = []
+    try:
+        if workers > 1:
+            workerStats = _runParallel(app, groups, workers, exported)
+        else:
+            _runSerial(app, groups, exported)
+        if manifest is not None:
+            manifest.recordLayers(app)
+    finally:
+        if manifest is not None:
+            manifest.save()
+    cache = app.getRenderCache()
+    if cache is not None:
+        cache.saveStats()
+    summary = ExportSummary()
+    summary.images = len(jobs)
+    summary.renders = len(groups)
+    summary.skipped = len(jobs) - len(pending)
+    summary.ellapsed = time.time() - totalStart
+    summary.peakRSS = utils.peakRSS()
+    workersRSS = [w['peakRSS'] for w in workerStats if w['peakRSS'] is not None]
+    summary.workersPeakRSS = max(workersRSS) if len(workersRSS) > 0 else None
+    summary.caches = mergeCacheStats([app.cacheStats()] + [w['caches'] for w in workerStats])
+    print('The process took {0} seconds'.format(summary.ellapsed))
+    print('{0} images exported with {1} renders, {2} renders saved by identical layer states, {3} up to date'.format(
+        summary.images, summary.renders, summary.rendersSaved(), summary.skipped))
+    if summary.peakRSS is not None:
+        print('Peak memory: {0:.0f} MiB{1}'.format(summary.peakRSS / 2**20, '' if summary.workersPeakRSS is None else
+            ', {0:.0f} MiB in the largest worker'.format(summary.workersPeakRSS / 2**20)))
+    rates = ['{0} {1:.0%}'.format(name, summary.hitRate(name)) for name in summary.caches.keys() if summary.hitRate(name) is not None]
+    if len(rates) > 0:
+        print('Cache hit rates: ' + ', '.join(rates))
+    budget = summary.caches['budget']
+    print('Cache memory: peak {0:.0f} MiB for a budget of {1:.0f} MiB per process, {2} evictions'.format(
+        budget['peakBytes'] / 2**20, budget['maxBytes'] / 2**20, budget['evictions']))
+    return summary
+
+def mergeCacheStats(stats:List[Dict[str, Dict[str, int]]]) -> Dict[str, Dict[str, int]]:
+    """
+    Add up the cache stats of several processes. The sizes and limits of the memory
+    budget are per process, the largest one is kept.
+    """
+    merged:Dict[str, Dict[str, int]] = {}
+    for s in stats:
+        for cache, values in s.items():
+            target = merged.setdefault(cache, {})
+            for k, v in values.items():
+                if k in ('maxBytes', 'peakBytes', 'bytes') and cache == 'budget':
+                    target[k] = max(target.get(k, 0), v)
+                else:
+                    target[k] = target.get(k, 0) + v
+    return merged
+
+def _runSerial(app:App, groups:List[RenderGroup], onExported:Callable[[str], None]):
+    # The images are encoded and written while the next ones are rendered
+    settings = app.exportSettings
+    writer = ImageWriter(settings.writerThreads, settings.writeQueueSize, onExported, app.getRenderCache())
+    try:
+        for group in groups:
+            imageStart = time.time()
+            im = renderJob(app, group.job)
+            print('Image rendered in {0} seconds'.format(time.time() - imageStart))
+            writer.put(im, group)
+    finally:
+        writer.close()
+
+def _runParallel(app:App, groups:List[RenderGroup], workers:int, onExported:Callable[[str], None]) -> List[Dict]:
+    """
+    Returns the last stats reported by every worker process
+    """
+    workerStats:Dict[int, Dict] = {}
+    # Keep the output of the workers on stderr too when it has been redirected here
+    # The render cache keys need the hash of the file, read it once here rather than in every worker
+    psdHash = app.getPSDHash() if app.getRenderCache() is not None else None
+    initargs = (app.originalPSDFilePath, app.configDict(), sys.stdout is sys.stderr, tracing.TRACER.enabled, psdHash)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=initargs) as pool:
+        futures = []
+        for g in groups:
+            # Every duplicate is sent with its own variation, it may have another output format
+            futures.append(pool.submit(_exportJob, g.job.variationIndex, g.job.combination.bitflags,
+                g.job.fname, [(d.variationIndex, d.combination.bitflags, d.fname) for d in g.duplicates]))
+        for f in as_completed(futures):
+            fnames, spans, stats = f.result()
+            tracing.TRACER.add([tracing.Span.from_dict(s) for s in spans])
+            workerStats[stats['pid']] = stats
+            for fname in fnames:
+                if onExported is not None:
+                    onExported(fname)
+    return list(workerStats.values())
+
+# State of the worker processes, every one of them loads the PSD once
+_workerApp:App = None
+
+def _initWorker(psdFile:str, config:Dict, stdoutToStderr:bool, trace:bool, psdHash:str):
+    global _workerApp
+    if stdoutToStderr:
+        sys.stdout = sys.stderr
+    # Forked workers start with a copy of the spans of this process
+    tracing.TRACER.clear()
+    tracing.TRACER.enable(trace)
+    _workerApp = App()
+    _workerApp.loadConfigDict(config)
+    _workerApp.loadPSD(psdFile)
+    if psdHash is not None:
+        _workerApp.psdHash = psdHash
+
+def _workerJob(variationIndex:int, bitflags:str, fname:str) -> ExportJob:
+    v = _workerApp.variations[variationIndex]
+    mods = _workerApp.lookupVariationModifiers(v)
+    comb = ModifierCombination.from_dict({'bitflags': bitflags})
+    return ExportJob(variationIndex, v, mods, comb, fname, _workerApp.outputFormatFor(v))
+
+def _exportJob(variationIndex:int, bitflags:str, fname:str, duplicates:List[Tuple[int, str, str]]) -> Tuple[List[str], List[Dict], Dict]:
+    """
+    Export a group of files, returns their names, the spans recorded meanwhile and
+    the memory and cache stats of the worker so far. The duplicates are given by their
+    variation index, bitflags and file name.
+    """
+    group = RenderGroup(_workerJob(variationIndex, bitflags, fname))
+    group.duplicates = [_workerJob(*d) for d in duplicates]
+    fnames = exportGroup(_workerApp, group)
+    cache = _workerApp.getRenderCache()
+    if cache is not None:
+        cache.saveStats()
+    stats = {'pid': os.getpid(), 'peakRSS': utils.peakRSS(), 'caches': _workerApp.cacheStats()}
+    return fnames, [s.to_dict() for s in tracing.TRACER.take()], stats
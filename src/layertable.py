@@ -0,0 +1,93 @@
+import hashlib
+from typing import Dict, List
+
+import numpy as np
+
+from models import ItemNode
+from patterns import PatternMatcher
+
+class LayerTable:
+    """
+    Flat view of the layer hierarchy. Every node gets an integer id, its position in
+    depth-first order, and a state of the layers is a NumPy bool array indexed by those ids.
+    Variations and modifiers become mask operations on those arrays, ItemNode trees are
+    only built when the GUI needs them.
+    """
+    def __init__(self, nodes:List[ItemNode]):
+        self.labels:List[str] = []
+        self.node_paths:List[str] = []
+        self.parents:List[int] = [] # Id of the parent node, -1 for the top level ones
+        visibility:List[bool] = []
+        self._flatten(nodes, -1, visibility)
+        self.visibility:np.ndarray = np.array(visibility, dtype=bool)
+        self.ids:Dict[str, int] = {self.node_paths[i]: i for i in range(len(self.node_paths))}
+        # Nodes matched by every set of patterns, the layer names never change
+        self._masks:Dict[tuple, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.node_paths)
+
+    def _flatten(self, nodes:List[ItemNode], parent:int, visibility:List[bool]):
+        for n in nodes:
+            id = len(self.node_paths)
+            self.labels.append(n.label)
+            self.node_paths.append(n.node_path)
+            self.parents.append(parent)
+            visibility.append(n.visible)
+            if len(n.children) > 0:
+                self._flatten(n.children, id, visibility)
+
+    def mask(self, matcher:PatternMatcher) -> np.ndarray:
+        """
+        Returns which nodes have a name matched by the patterns
+        """
+        mask = self._masks.get(matcher.patterns)
+        if mask is None:
+            mask = np.fromiter((matcher.matches(l) for l in self.labels), dtype=bool, count=len(self.labels))
+            self._masks[matcher.patterns] = mask
+        return mask
+
+    def applyPatterns(self, visibility:np.ndarray, inclusions:PatternMatcher, exclusions:PatternMatcher) -> np.ndarray:
+        """
+        Show the nodes matched by the inclusions and then hide the ones matched by
+        the exclusions. Returns a new array, the given one is left untouched.
+        """
+        visibility = visibility.copy()
+        visibility[self.mask(inclusions)] = True
+        visibility[self.mask(exclusions)] = False
+        return visibility
+
+    def fromNodes(self, nodes:List[ItemNode], visibility:np.ndarray = None) -> np.ndarray:
+        """
+        Returns the state described by a node tree. The nodes that aren't in the
+        tree keep the visibility they have in the given array.
+        """
+        visibility = (self.visibility if visibility is None else visibility).copy()
+        self._fromNodesRecursive(nodes, visibility)
+        return visibility
+
+    def _fromNodesRecursive(self, nodes:List[ItemNode], visibility:np.ndarray):
+        for n in nodes:
+            id = self.ids.get(n.node_path)
+            if id is not None:
+                visibility[id] = n.visible
+            if len(n.children) > 0:
+                self._fromNodesRecursive(n.children, visibility)
+
+    def toNodes(self, visibility:np.ndarray) -> List[ItemNode]:
+        """
+        Build the node tree of a state, for the views that work with ItemNode
+        """
+        items = [ItemNode(self.labels[i], bool(visibility[i]), self.node_paths[i]) for i in range(len(self))]
+        roots = []
+        for i in range(len(items)):
+            parent = self.parents[i]
+            if parent < 0:
+                roots.append(items[i])
+            else:
+                items[parent].addChild(items[i])
+        return roots
+
+    @staticmethod
+    def fingerprint(visibility:np.ndarray) -> str:
+        return hashlib.sha1(np.packbits(visibility).tobytes()).hexdigest()
@@ -3,6 +3,13 @@ from typing import List, Dict
 from psd_tools import PSDImage
 from PIL.Image import Image
 
+from patterns import PatternMatcher
+
+FORMAT_PNG = 'png'
+FORMAT_WEBP = 'webp'
+FORMAT_JPEG = 'jpeg'
+FORMAT_EXTENSIONS = {FORMAT_PNG: '.png', FORMAT_WEBP: '.webp', FORMAT_JPEG: '.jpg'}
+
 class ItemNode:
     def __init__(self, label:str='', visible:bool=False, node_path:str = None):
         self.label:str = label
@@ -14,9 +21,10 @@ class ItemNode:
         self.children.append(child)
 
 class AppState:
-    def __init__(self, psd:PSDImage=None, thumbnail:Image=None):
+    def __init__(self, psd:PSDImage=None, thumbnail:Image=None, visibility=None):
         self.psd:PSDImage = psd
         self.thumbnail:Image = thumbnail
+        self.visibility = visibility # State of the layer table the thumbnail was rendered with
     def __repr__(self) -> str:
         return '<AppState psd="{0}", thumbnail="{1}">'.format(repr(self.psd), repr(self.thumbnail))
 
@@ -27,6 +35,24 @@ class VariationMixin:
         self.suffix:str = ''
         self.inclusions:List[str] = []
         self.exclusions:List[str] = []
+        self._inclusionMatcher:PatternMatcher = None
+        self._exclusionMatcher:PatternMatcher = None
+
+    def inclusionMatcher(self) -> PatternMatcher:
+        """
+        Returns the compiled inclusion patterns, compiled again only if they changed
+        """
+        if self._inclusionMatcher is None or self._inclusionMatcher.patterns != tuple(self.inclusions):
+            self._inclusionMatcher = PatternMatcher(self.inclusions)
+        return self._inclusionMatcher
+
+    def exclusionMatcher(self) -> PatternMatcher:
+        """
+        Returns the compiled exclusion patterns, compiled again only if they changed
+        """
+        if self._exclusionMatcher is None or self._exclusionMatcher.patterns != tuple(self.exclusions):
+            self._exclusionMatcher = PatternMatcher(self.exclusions)
+        return self._exclusionMatcher
 
     def load_dict(self, d:Dict):
         self.id = d.get('id', 0)
@@ -65,28 +91,108 @@ class ModifierCombination:
     def to_dict(self) -> Dict:
         return {"name": self.name, "bitflags": self.bitflags}
 
+class OutputFormat:
+    """
+    Encoder and settings the exported images are written with
+    """
+    def __init__(self) -> None:
+        self.format:str = FORMAT_PNG
+        self.compressLevel:int = 6 # PNG, from 0 (fastest) to 9 (smallest)
+        self.optimize:bool = False # PNG, extra pass to find the smallest encoding
+        self.lossless:bool = True # WebP
+        self.quality:int = 90 # Lossy WebP and JPEG
+        self.background:str = '#ffffff' # JPEG has no transparency, the image is flattened on this color
+
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS.get(self.format, '.png')
+
+    def load_dict(self, d:Dict):
+        self.format = d.get('format', FORMAT_PNG)
+        self.compressLevel = d.get('compressLevel', 6)
+        self.optimize = d.get('optimize', False)
+        self.lossless = d.get('lossless', True)
+        self.quality = d.get('quality', 90)
+        self.background = d.get('background', '#ffffff')
+
+    @classmethod
+    def from_dict(cls, d:Dict) -> 'OutputFormat':
+        inst = OutputFormat()
+        inst.load_dict(d)
+        return inst
+
+    def to_dict(self) -> Dict:
+        return {"format": self.format, "compressLevel": self.compressLevel, "optimize": self.optimize,
+                "lossless": self.lossless, "quality": self.quality, "background": self.background}
+
 class Variation(VariationMixin):
     def __init__(self):
         super().__init__()
         self.subfolder:str = ''
         self.modifiers:List[int] = [] # List of modifier IDs
         self.combinations:List[ModifierCombination] = []
+        self.outputFormat:OutputFormat = None # Overrides the one of the export settings
 
     def load_dict(self, d:Dict):
         super().load_dict(d)
         self.subfolder = d.get('subfolder', '')
         self.modifiers = d.get('modifiers', [])
         self.combinations = [ModifierCombination.from_dict(x) for x in d.get('combinations', [])]
+        self.outputFormat = OutputFormat.from_dict(d['output']) if 'output' in d else None
     
     def to_dict(self) -> Dict:
         d = super().to_dict()
         d['subfolder'] = self.subfolder
         d['modifiers'] = self.modifiers
         d['combinations'] = [x.to_dict() for x in self.combinations]
+        if self.outputFormat is not None:
+            d['output'] = self.outputFormat.to_dict()
         return d
     
     @classmethod
     def from_dict(cls, d:Dict) -> 'Variation':
         inst = Variation()
         inst.load_dict(d)
-        return inst
\ No newline at end of file
+        return inst
+
+class ExportSettings:
+    def __init__(self) -> None:
+        self.jobs:int = 1 # Number of processes rendering in parallel, 0 means one per CPU
+        self.groupCacheMB:int = 512 # Memory for the composites of unchanged groups, per process
+        self.memoryBudgetMB:int = 4096 # Memory for all the layer, group and preview caches, per process. 0 means no limit
+        self.writerThreads:int = 2 # Threads encoding and writing the images, 0 writes them on the render thread
+        self.writeQueueSize:int = 2 # Rendered images that can wait for a writer
+        self.outputFormat:OutputFormat = OutputFormat()
+        self.incremental:bool = True # Skip the outputs of a previous export that are still up to date
+        self.renderCacheMB:int = 2048 # Disk space for renders kept across sessions, 0 disables the cache
+        self.lazyLoad:bool = False # Map the PSD file in memory and read the pixels of a layer when it's first rendered
+        self.trace:bool = False # Time every step and write the traces to the output folder after an export
+        self.batchJobs:int = 0 # PSD files of a batch exported at once, 0 sizes it to the CPUs and memory
+        self.staticSlabs:bool = True # Composite once the runs of layers no variation or modifier toggles
+
+    def load_dict(self, d:Dict):
+        self.jobs = d.get('jobs', 1)
+        self.groupCacheMB = d.get('groupCacheMB', 512)
+        self.memoryBudgetMB = d.get('memoryBudgetMB', 4096)
+        self.writerThreads = d.get('writerThreads', 2)
+        self.writeQueueSize = d.get('writeQueueSize', 2)
+        self.outputFormat = OutputFormat.from_dict(d.get('output', {}))
+        self.incremental = d.get('incremental', True)
+        self.renderCacheMB = d.get('renderCacheMB', 2048)
+        self.lazyLoad = d.get('lazyLoad', False)
+        self.trace = d.get('trace', False)
+        self.batchJobs = d.get('batchJobs', 0)
+        self.staticSlabs = d.get('staticSlabs', True)
+
+    @classmethod
+    def from_dict(cls, d:Dict) -> 'ExportSettings':
+        inst = ExportSettings()
+        inst.load_dict(d)
+        return inst
+
+    def to_dict(self) -> Dict:
+        return {"jobs": self.jobs, "groupCacheMB": self.groupCacheMB, "memoryBudgetMB": self.memoryBudgetMB,
+                "writerThreads": self.writerThreads, "writeQueueSize": self.writeQueueSize,
+                "output": self.outputFormat.to_dict(), "incremental": self.incremental,
+                "renderCacheMB": self.renderCacheMB, "lazyLoad": self.lazyLoad,
+                "trace": self.trace, "batchJobs": self.batchJobs,
+                "staticSlabs": self.staticSlabs}
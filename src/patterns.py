@@ -0,0 +1,53 @@
+import os
+import re
+import fnmatch
+from typing import Dict, List, Pattern
+
+PATTERN_GLOB = 'glob'
+PATTERN_REGEX = 'regex'
+
+# Regex features that stop meaning the same thing once the patterns are merged
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+class PatternMatcher:
+    """
+    Matches layer names against a list of 'type:body' patterns. All the patterns are
+    compiled once into a single alternation and the result for every name is remembered,
+    since the same names are checked again for every variation and combination.
+    """
+    def __init__(self, patterns:List[str]):
+        self.patterns = tuple(patterns)
+        self.regexes:List[Pattern] = self._compile(self.patterns)
+        self._results:Dict[str, bool] = {}
+
+    def matches(self, label:str) -> bool:
+        result = self._results.get(label)
+        if result is None:
+            result = any(r.match(label) is not None for r in self.regexes)
+            self._results[label] = result
+        return result
+
+    @staticmethod
+    def _toRegex(patt:str) -> str:
+        sep = patt.find(':')
+        patt_type = patt[0:sep] if sep >= 0 else ''
+        patt_body = patt[sep+1:]
+        if patt_type == PATTERN_GLOB:
+            regex = fnmatch.translate(patt_body)
+            if os.path.normcase('A') != 'A':
+                # fnmatch ignores the case where the file system does (Windows)
+                regex = '(?i:' + regex + ')'
+            return regex
+        return patt_body
+
+    def _compile(self, patterns:tuple) -> List[Pattern]:
+        regexes = [self._toRegex(p) for p in patterns]
+        if len(regexes) == 0:
+            return []
+        if not any(_BACKREFERENCE.search(r) for r in regexes):
+            try:
+                return [re.compile('|'.join('(?:' + r + ')' for r in regexes))]
+            except re.error:
+                # Some patterns can't be merged (e.g. global flags or duplicated group names)
+                pass
+        return [re.compile(r) for r in regexes]
@@ -0,0 +1,183 @@
+import io
+import os
+import mmap
+import struct
+import hashlib
+from typing import List, Tuple
+
+import attr
+from psd_tools import PSDImage
+from psd_tools.constants import Tag
+from psd_tools.psd.tagged_blocks import TaggedBlocks
+
+# Tagged blocks of a layer record that don't change how it renders: the name is up to the
+# patterns, and the section divider also tells whether a group is expanded in Photoshop
+LAYER_HASH_IGNORED_BLOCKS = (Tag.UNICODE_LAYER_NAME, Tag.SECTION_DIVIDER_SETTING)
+
+# Reads of the pixel sections smaller than this are copied, they're the compression
+# markers in front of every channel
+MIN_MAPPED_READ = 64
+
+class MappedPSDFile(io.RawIOBase):
+    """
+    Read-only view of a PSD file mapped in memory. Reads that fall in the compressed
+    pixel data (the channels of the layers and the merged image) return slices of the
+    mapping instead of copies, so opening the document only parses the layer records
+    and the group structure. The OS reads the pixels of a layer from the disk when
+    they're first decoded, and can drop them again when memory gets tight.
+    Everything else is returned as bytes, like a regular file.
+    The file must not be modified while it's mapped: the layers would read the new bytes,
+    or crash the process if it got shorter. See changed and detach.
+    """
+    def __init__(self, fpath:str):
+        super().__init__()
+        self.fpath:str = fpath
+        with open(fpath, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            self.stat:Tuple[int, int] = (st.st_size, st.st_mtime_ns)
+            self.mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+        self.position = 0
+        self.pixelRanges:List[Tuple[int, int]] = pixelDataRanges(self.mapping)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = len(self.mapping) + offset
+        else:
+            raise ValueError('Invalid whence: {0}'.format(whence))
+        return self.position
+
+    def read(self, size:int = -1):
+        start = self.position
+        end = len(self.mapping) if size is None or size < 0 else min(start + size, len(self.mapping))
+        self.position = max(end, start)
+        if end - start >= MIN_MAPPED_READ and any(s <= start and end <= e for s, e in self.pixelRanges):
+            return self.view[start:end]
+        return self.mapping[start:end]
+
+    def close(self):
+        # The layers keep slices of the mapping, it's released with the last of them
+        super().close()
+
+    def changed(self) -> bool:
+        """
+        Whether the file was saved or deleted since it was mapped
+        """
+        try:
+            st = os.stat(self.fpath)
+        except OSError:
+            return True
+        return (st.st_size, st.st_mtime_ns) != self.stat
+
+    def detach(self, psd:PSDImage):
+        """
+        Copy the pixel data the PSD object still reads from the mapping and release it, so
+        the file can be saved by other applications. A slice still being decoded on another
+        thread keeps the mapping until it's done.
+        """
+        record = psd._record
+        for channels in record.layer_and_mask_information.layer_info.channel_image_data or []:
+            for channel in channels:
+                if isinstance(channel.data, memoryview):
+                    channel.data = bytes(channel.data)
+        if record.image_data is not None and isinstance(record.image_data.data, memoryview):
+            record.image_data.data = bytes(record.image_data.data)
+        self.view.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass
+        self.pixelRanges = []
+
+def pixelDataRanges(data) -> List[Tuple[int, int]]:
+    """
+    Returns where the channel image data of the layers and the merged image data are in
+    a PSD or PSB file, walking the section lengths and the layer records only. A file
+    that doesn't look as expected gets no ranges, it's then read like a regular file.
+    16 and 32 bit documents keep their layers in a tagged block, only their merged image is found.
+    """
+    try:
+        version = struct.unpack_from('>H', data, 4)[0]
+        lengthFmt, lengthSize = ('>I', 4) if version == 1 else ('>Q', 8)
+        pos = 26 # File header
+        pos += 4 + struct.unpack_from('>I', data, pos)[0] # Color mode data
+        pos += 4 + struct.unpack_from('>I', data, pos)[0] # Image resources
+        layerAndMaskLength = struct.unpack_from(lengthFmt, data, pos)[0]
+        pos += lengthSize
+        imageDataStart = pos + layerAndMaskLength
+        ranges = []
+        if layerAndMaskLength > 0 and struct.unpack_from(lengthFmt, data, pos)[0] > 0:
+            pos += lengthSize
+            count = abs(struct.unpack_from('>h', data, pos)[0])
+            pos += 2
+            channelsLength = 0
+            for _ in range(count):
+                pos += 16 # Bounds
+                channels = struct.unpack_from('>H', data, pos)[0]
+                pos += 2
+                for _ in range(channels):
+                    channelsLength += struct.unpack_from(lengthFmt, data, pos + 2)[0]
+                    pos += 2 + lengthSize
+                pos += 12 # Blend mode, opacity, clipping and flags
+                pos += 4 + struct.unpack_from('>I', data, pos)[0] # Mask, blending ranges, name and tagged blocks
+            ranges.append((pos, pos + channelsLength))
+        if imageDataStart <= len(data):
+            ranges.append((imageDataStart, len(data)))
+        return ranges
+    except struct.error:
+        return []
+
+def readCanvasSize(fpath:str) -> Tuple[int, int]:
+    """
+    Returns the width and height of a PSD file from its header, without parsing the rest
+    """
+    with open(fpath, 'rb') as fp:
+        header = fp.read(26)
+    if len(header) < 26 or header[0:4] != b'8BPS':
+        raise ValueError('Not a PSD file: {0}'.format(fpath))
+    height, width = struct.unpack_from('>II', header, 14)
+    return width, height
+
+def layerContentHash(layer) -> str:
+    """
+    Hash of what a layer renders: its compressed pixels, masks, blending options and
+    effects. The name and the visibility are left out, they're what the variations change.
+    """
+    record = layer._record
+    blocks = TaggedBlocks([(k, v) for k, v in record.tagged_blocks.items() if k not in LAYER_HASH_IGNORED_BLOCKS])
+    record = attr.evolve(record, name='', flags=attr.evolve(record.flags, visible=True), tagged_blocks=blocks)
+    fp = io.BytesIO()
+    record.write(fp, version=layer._psd.version)
+    h = hashlib.sha1(fp.getvalue())
+    h.update('{0}/{1}'.format(layer.kind, layer.blend_mode).encode('utf-8'))
+    for channel in layer._channels:
+        h.update(channel.data)
+    return h.hexdigest()
+
+def openPSD(fpath:str, lazy:bool = False) -> Tuple[PSDImage, MappedPSDFile]:
+    """
+    Open a PSD file. A lazy one is memory-mapped, see MappedPSDFile. Returns the
+    mapped file too, None when the file was read whole.
+    """
+    if not lazy:
+        return PSDImage.open(fpath), None
+    try:
+        fp = MappedPSDFile(fpath)
+    except (OSError, ValueError) as e:
+        # Empty files can't be mapped, and some file systems don't support it
+        print('WARN: Could not map {0} in memory, reading it whole: {1}'.format(fpath, e))
+        return PSDImage.open(fpath), None
+    return PSDImage.open(fp), fp
@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Tuple
+
+from models import ItemNode
+
+INDEX_VERSION = 1
+
+class PSDIndex:
+    """
+    Sidecar of a PSD file with what the application shows before rendering anything:
+    the layer tree (names, node paths, initial visibility and bounding boxes), the size
+    of the document and the hashes of its content and of every layer. Reopening a known file reads it instead
+    of waiting for the layer records to be parsed. It's stored in a cache folder, one file
+    per PSD path, and only matches while the size and modification time of the PSD are the same.
+    """
+    def __init__(self, cacheDir:str, psdPath:str):
+        self.psdPath:str = os.path.abspath(psdPath)
+        self.path:str = os.path.join(cacheDir, hashlib.sha1(self.psdPath.encode('utf-8')).hexdigest() + '.json')
+        self.fileSize:int = 0
+        self.fileMtime:int = 0 # Nanoseconds
+        self.size:Tuple[int, int] = (0, 0)
+        self.psdHash:str = None
+        self.layerHashes:Dict[str, str] = None # By node path, see psdfile.layerContentHash
+        self.compositorSupported:bool = False
+        self.layers:List[Dict] = [] # Nested like the layer tree, see nodeDict
+
+    @classmethod
+    def load(cls, cacheDir:str, psdPath:str) -> 'PSDIndex':
+        """
+        Returns the index of a PSD file, or None when it's unknown or changed since it was indexed
+        """
+        inst = PSDIndex(cacheDir, psdPath)
+        try:
+            st = os.stat(inst.psdPath)
+            with open(inst.path, 'rt') as fp:
+                d = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if d.get('version') != INDEX_VERSION or d.get('fileSize') != st.st_size or d.get('fileMtime') != st.st_mtime_ns:
+            return None
+        inst.fileSize = st.st_size
+        inst.fileMtime = st.st_mtime_ns
+        inst.size = tuple(d.get('size', (0, 0)))
+        inst.psdHash = d.get('psdHash')
+        inst.layerHashes = d.get('layerHashes')
+        inst.compositorSupported = d.get('compositorSupported', False)
+        inst.layers = d.get('layers', [])
+        return inst
+
+    @classmethod
+    def build(cls, cacheDir:str, psdPath:str, psd, nodes:List[ItemNode], layers:Dict[str, object],
+            compositorSupported:bool) -> 'PSDIndex':
+        """
+        Index a parsed PSD file from its layer tree and the layers by node path
+        """
+        inst = PSDIndex(cacheDir, psdPath)
+        st = os.stat(inst.psdPath)
+        inst.fileSize = st.st_size
+        inst.fileMtime = st.st_mtime_ns
+        inst.size = tuple(psd.size)
+        inst.compositorSupported = compositorSupported
+        inst.layers = [inst.nodeDict(n, layers) for n in nodes]
+        return inst
+
+    def nodeDict(self, node:ItemNode, layers:Dict[str, object]) -> Dict:
+        layer = layers.get(node.node_path)
+        return {'name': node.label, 'path': node.node_path, 'visible': node.visible,
+                'bbox': list(layer.bbox) if layer is not None else None,
+                'children': [self.nodeDict(c, layers) for c in node.children]}
+
+    def toNodes(self) -> List[ItemNode]:
+        """
+        Build the original layer tree
+        """
+        return [self._toNode(d) for d in self.layers]
+
+    def _toNode(self, d:Dict) -> ItemNode:
+        node = ItemNode(d['name'], d['visible'], d['path'])
+        node.children = [self._toNode(c) for c in d.get('children', [])]
+        return node
+
+    def save(self):
+        d = {'version': INDEX_VERSION, 'psdPath': self.psdPath, 'fileSize': self.fileSize,
+             'fileMtime': self.fileMtime, 'size': list(self.size), 'psdHash': self.psdHash,
+             'layerHashes': self.layerHashes, 'compositorSupported': self.compositorSupported, 'layers': self.layers}
+        tmpPath = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmpPath, 'wt') as fp:
+                json.dump(d, fp, separators=(',', ':'))
+            os.replace(tmpPath, self.path)
+        except OSError as e:
+            print('WARN: Could not save the layer index of {0}: {1}'.format(self.psdPath, e))
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+STATS_FILENAME = 'stats.json'
+CACHE_EXT = '.png'
+
+class RenderCache:
+    """
+    Renders stored on disk by content: the hash of the PSD file, the visibility of its
+    layers and the size of the image. The same state renders the same pixels whatever
+    session or output folder asked for it. Once the files take more than maxBytes the
+    least recently used ones are deleted.
+    """
+    def __init__(self, cacheDir:str, maxBytes:int):
+        self.cacheDir:str = cacheDir
+        self.maxBytes:int = maxBytes
+        # Size and last use of every entry by key, filled from the folder on first use
+        self.entries:Dict[str, Tuple[int, float]] = None
+        self.bytes:int = 0
+        self.hits:int = 0
+        self.misses:int = 0
+        self.stores:int = 0
+        self.evictions:int = 0
+        # Counters of this session already added to the stats file, see saveStats
+        self.saved:Dict[str, int] = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        # The exporter stores files from its writer threads
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(psdHash:str, visibilityFingerprint:str, size:Tuple[int, int]) -> str:
+        return hashlib.sha1('{0}/{1}/{2}x{3}'.format(psdHash, visibilityFingerprint, size[0], size[1]).encode('ascii')).hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.cacheDir, key[0:2], key + CACHE_EXT)
+
+    def _scan(self):
+        # Called with the lock held
+        if self.entries is not None:
+            return
+        self.entries = {}
+        self.bytes = 0
+        if not os.path.isdir(self.cacheDir):
+            return
+        for root, _, files in os.walk(self.cacheDir):
+            for f in files:
+                if not f.endswith(CACHE_EXT):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except OSError:
+                    continue
+                self.entries[f[:-len(CACHE_EXT)]] = (st.st_size, st.st_mtime)
+                self.bytes += st.st_size
+
+    def get(self, key:str) -> Image.Image:
+        """
+        Returns the cached render, or None
+        """
+        fpath = self.path(key)
+        try:
+            with Image.open(fpath) as im:
+                im.load()
+                image = im.convert('RGBA') if im.mode != 'RGBA' else im.copy()
+            # The modification time tells the least recently used entries
+            os.utime(fpath)
+        except (OSError, ValueError):
+            # Not cached, evicted by another process or unreadable
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self._scan()
+            self.hits += 1
+            if key in self.entries:
+                self.entries[key] = (self.entries[key][0], time.time())
+        return image
+
+    def put(self, key:str, image:Image.Image):
+        """
+        Store a render. The cache is written with the fastest PNG compression, it's
+        meant for images small enough to be encoded on the spot, like previews.
+        """
+        self._store(key, lambda tmpPath: image.save(tmpPath, 'PNG', compress_level=1))
+
+    def putFile(self, key:str, fpath:str):
+        """
+        Store a render that's already written as a PNG file, e.g. an exported image.
+        The file is copied, a link would let an edit of the exported image change the
+        cached render, and the lookups touch the modification time of the entries.
+        """
+        self._store(key, lambda tmpPath: shutil.copyfile(fpath, tmpPath))
+
+    def _store(self, key:str, write):
+        with self.lock:
+            self._scan()
+            if self.maxBytes <= 0 or key in self.entries:
+                return
+        fpath = self.path(key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        # Written aside and moved in place, so other processes never read half a file
+        tmpPath = '{0}.{1}.tmp'.format(fpath, os.getpid())
+        try:
+            write(tmpPath)
+            os.replace(tmpPath, fpath)
+            size = os.path.getsize(fpath)
+        except OSError as e:
+            print('WARN: Could not write to the render cache: {0}'.format(e))
+            return
+        with self.lock:
+            if key not in self.entries:
+                self.bytes += size
+            self.entries[key] = (size, time.time())
+            self.stores += 1
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in maxBytes
+        """
+        with self.lock:
+            self._scan()
+            if self.bytes <= self.maxBytes:
+                return
+            for key in sorted(self.entries.keys(), key=lambda k: self.entries[k][1]):
+                if self.bytes <= self.maxBytes:
+                    break
+                size, _ = self.entries.pop(key)
+                self.bytes -= size
+                self.evictions += 1
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            if os.path.isdir(self.cacheDir):
+                shutil.rmtree(self.cacheDir)
+            self.entries = {}
+            self.bytes = 0
+
+    def saveStats(self):
+        """
+        Add the counters of this session, the ones not saved yet, to the ones kept in the cache folder
+        """
+        with self.lock:
+            self._saveStats()
+
+    def _counters(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions}
+
+    def _unsaved(self) -> Dict[str, int]:
+        counters = self._counters()
+        return {k: counters[k] - self.saved[k] for k in counters.keys()}
+
+    def _saveStats(self):
+        unsaved = self._unsaved()
+        if sum(unsaved.values()) == 0:
+            return
+        totals = self.loadStats()
+        for k, v in unsaved.items():
+            totals[k] += v
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with open(os.path.join(self.cacheDir, STATS_FILENAME), 'wt') as fp:
+                json.dump(totals, fp)
+        except OSError as e:
+            print('WARN: Could not save the render cache stats: {0}'.format(e))
+            return
+        self.saved = self._counters()
+
+    def loadStats(self) -> Dict[str, int]:
+        totals = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        try:
+            with open(os.path.join(self.cacheDir, STATS_FILENAME), 'rt') as fp:
+                totals.update(json.load(fp))
+        except (OSError, ValueError):
+            pass
+        return totals
+
+    def report(self) -> str:
+        with self.lock:
+            self._scan()
+        totals = self.loadStats()
+        with self.lock:
+            for k, v in self._unsaved().items():
+                totals[k] += v
+        lookups = totals['hits'] + totals['misses']
+        lines = [
+            'Render cache: {0}'.format(self.cacheDir),
+            '  {0} entries, {1:.1f} of {2:.1f} MiB'.format(len(self.entries), self.bytes / 2**20, self.maxBytes / 2**20),
+            '  this session: {0} hits, {1} misses, {2} stored, {3} evicted'.format(
+                self.hits, self.misses, self.stores, self.evictions),
+            '  all sessions: {0} hits, {1} misses ({2:.0%} hit rate), {3} stored, {4} evicted'.format(
+                totals['hits'], totals['misses'], totals['hits'] / lookups if lookups > 0 else 0.0,
+                totals['stores'], totals['evictions']),
+        ]
+        return '\n'.join(lines)
+
+
+def main(argv:List[str]) -> int:
+    from app import App
+    import utils
+    parser = argparse.ArgumentParser(description='Report the usage of the render cache, or clear it')
+    parser.add_argument('-c', '--config', default=os.path.join(utils.getBasedir(), 'variations_settings.json'),
+        help='The variations_settings.json file with the cache settings')
+    parser.add_argument('--clear', action='store_true', help='Delete all the cached renders')
+    args = parser.parse_args(argv)
+    app = App()
+    app.loadVariationConfig(args.config)
+    cache = app.getRenderCache()
+    if cache is None:
+        print('The render cache is disabled (export.renderCacheMB is 0)')
+        return 0
+    if args.clear:
+        cache.clear()
+    print(cache.report())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
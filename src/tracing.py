@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from typing import Dict, Iterator, List
+
+# Names of the spans recorded by the application
+SPAN_PARSE = 'parse'
+SPAN_HIERARCHY = 'hierarchy'
+SPAN_PATTERNS = 'patterns'
+SPAN_VISIBILITY = 'visibility'
+SPAN_COMPOSITE = 'composite'
+SPAN_ENCODE = 'encode'
+SPAN_WRITE = 'write'
+
+TRACE_FILENAME = 'export_trace.json'
+SPANS_FILENAME = 'export_spans.json'
+
+class Span:
+    def __init__(self, name:str, start:float, duration:float, tags:Dict):
+        self.name:str = name
+        self.start:float = start # Seconds of time.perf_counter
+        self.duration:float = duration
+        self.tags:Dict = tags
+        self.pid:int = os.getpid()
+        self.thread:str = threading.current_thread().name
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'start': self.start, 'duration': self.duration, 'tags': self.tags,
+                'pid': self.pid, 'thread': self.thread}
+
+    @classmethod
+    def from_dict(cls, d:Dict) -> 'Span':
+        inst = Span(d['name'], d['start'], d['duration'], d.get('tags', {}))
+        inst.pid = d.get('pid', 0)
+        inst.thread = d.get('thread', '')
+        return inst
+
+
+class Tracer:
+    """
+    Records how long the named steps of loading, rendering and exporting take. Spans
+    nest on every thread and inherit the tags of the spans around them, so the encode
+    of an image carries the variation and combination of its export. Nothing is recorded
+    until it's enabled. The clock is time.perf_counter, which is shared by the processes
+    of a machine, so the spans of the export workers can be merged with the ones here.
+    """
+    def __init__(self):
+        self.enabled:bool = False
+        self.spans:List[Span] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, enabled:bool = True):
+        self.enabled = enabled
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+    def _stack(self) -> List[Dict]:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def span(self, name:str, **tags) -> Iterator[None]:
+        """
+        Time the block, tagged with the given tags and the ones of the blocks around it
+        """
+        if not self.enabled:
+            yield
+            return
+        with self.tags(**tags):
+            merged = self._stack()[-1]
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                duration = time.perf_counter() - start
+                with self.lock:
+                    self.spans.append(Span(name, start, duration, merged))
+
+    @contextlib.contextmanager
+    def tags(self, **tags) -> Iterator[None]:
+        """
+        Tag the spans recorded in the block without timing the block itself
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        merged = dict(stack[-1]) if len(stack) > 0 else {}
+        merged.update(tags)
+        stack.append(merged)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def add(self, spans:List[Span]):
+        """
+        Add spans recorded somewhere else, e.g. by an export worker process
+        """
+        with self.lock:
+            self.spans.extend(spans)
+
+    def take(self) -> List[Span]:
+        """
+        Returns the spans recorded so far and forgets them
+        """
+        with self.lock:
+            spans = self.spans
+            self.spans = []
+        return spans
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        Count and total, mean and maximum duration of every span name
+        """
+        result = {}
+        with self.lock:
+            spans = list(self.spans)
+        for s in spans:
+            r = result.setdefault(s.name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            r['count'] += 1
+            r['total'] += s.duration
+            r['max'] = max(r['max'], s.duration)
+        for r in result.values():
+            r['mean'] = r['total'] / r['count']
+        return result
+
+    def saveJSON(self, fpath:str):
+        """
+        Write the spans and their summary, with the times relative to the first span
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        origin = spans[0].start if len(spans) > 0 else 0.0
+        data = {'summary': self.summary(), 'spans': []}
+        for s in spans:
+            d = s.to_dict()
+            d['start'] = s.start - origin
+            data['spans'].append(d)
+        with open(fpath, 'wt') as fp:
+            json.dump(data, fp, indent=1)
+
+    def saveChromeTrace(self, fpath:str):
+        """
+        Write the spans as trace events, for chrome://tracing or https://ui.perfetto.dev
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        origin = spans[0].start if len(spans) > 0 else 0.0
+        threadIds:Dict[tuple, int] = {}
+        events = []
+        for s in spans:
+            key = (s.pid, s.thread)
+            if key not in threadIds:
+                threadIds[key] = len(threadIds) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': s.pid, 'tid': threadIds[key],
+                               'args': {'name': s.thread}})
+            events.append({'name': s.name, 'ph': 'X', 'pid': s.pid, 'tid': threadIds[key],
+                           'ts': (s.start - origin) * 1e6, 'dur': s.duration * 1e6, 'args': s.tags})
+        with open(fpath, 'wt') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+# The tracer of the application, disabled by default
+TRACER = Tracer()
+
+def span(name:str, **tags):
+    """
+    Time a block of code on the application tracer, see Tracer.span
+    """
+    return TRACER.span(name, **tags)
+
+def tags(**tags):
+    """
+    Tag the spans of a block on the application tracer, see Tracer.tags
+    """
+    return TRACER.tags(**tags)
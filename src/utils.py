@@ -1,10 +1,16 @@
+import io
 import re
 import sys
 import os
 import math
-from typing import List
+import shutil
+import hashlib
+from typing import List, Set
 
-from models import Modifier, ModifierCombination, Variation
+from PIL import Image
+
+from models import Modifier, ModifierCombination, Variation, OutputFormat, FORMAT_WEBP, FORMAT_JPEG
+import tracing
 
 def combinationName(mods:List[Modifier], variationName:str, bitflags:str) -> str:
     flags = int(bitflags, 2)
@@ -32,13 +38,23 @@ def getSuffixFor(variation:Variation, mods:List[Modifier]) -> str:
             suffix += m.suffix
     return suffix
 
-def getUniqueFilename(destFolder:str, baseFileName:str, ext:str) -> str:
+def getUniqueFilename(destFolder:str, baseFileName:str, ext:str, reserved:Set[str] = None, owned:Set[str] = None) -> str:
+    """
+    Returns a path that doesn't exist yet. The optional reserved set holds the names already
+    handed out for files that aren't written yet, the new name is added to it. The files
+    in the optional owned set (normalized paths) may be overwritten, they count as free.
+    """
+    if reserved is None:
+        reserved = set()
+    if owned is None:
+        owned = set()
     fname = os.path.join(destFolder, baseFileName + ext)
     i = 1
-    while os.path.exists(fname):
+    while (os.path.exists(fname) and os.path.normpath(fname) not in owned) or fname in reserved:
         print('WARN: File name clash detected on '+ fname)
         fname = os.path.join(destFolder, baseFileName + str(i) + ext)
         i += 1
+    reserved.add(fname)
     return fname
 
 def isValidRegex(s:str) -> bool:
@@ -74,4 +90,97 @@ def findIndex(l:List, val) -> int:
         idx = l.index(val)
     except ValueError:
         pass
-    return idx
\ No newline at end of file
+    return idx
+
+def linkOrCopy(src:str, dst:str):
+    """
+    Hardlink dst to src when the file system allows it, copy the file otherwise
+    """
+    tmpPath = tempPath(dst)
+    removeLink(tmpPath)
+    try:
+        os.link(src, tmpPath)
+    except OSError:
+        shutil.copyfile(src, tmpPath)
+    os.replace(tmpPath, dst)
+
+def fileHash(fpath:str) -> str:
+    """
+    sha1 of the content of a file, read in chunks
+    """
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def peakRSS(children:bool = False) -> int:
+    """
+    Largest resident memory of this process in bytes so far, or of the largest of its
+    finished child processes. None where the platform doesn't tell.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+def availableMemory() -> int:
+    """
+    Memory in bytes that new processes can use without swapping, or None where the platform doesn't tell
+    """
+    try:
+        with open('/proc/meminfo', 'rt') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def removeLink(fname:str):
+    """
+    Remove a file or link if there's one, e.g. a temporary file left by an interrupted write
+    """
+    if os.path.lexists(fname):
+        os.remove(fname)
+
+def tempPath(fname:str) -> str:
+    """
+    Where to write a file before moving it in place with os.replace: next to it, so
+    the move stays on the same file system. An interrupted export never leaves half a
+    file under the final name, and a hardlink shared with other outputs is replaced
+    without changing them.
+    """
+    return '{0}.{1}.tmp'.format(fname, os.getpid())
+
+def saveImage(image:Image.Image, fname:str, outputFormat:OutputFormat):
+    """
+    Encode and write the image with the given format and settings. The image is
+    encoded in memory first, so both steps can be timed apart.
+    """
+    buffer = io.BytesIO()
+    with tracing.span(tracing.SPAN_ENCODE, format=outputFormat.format):
+        if outputFormat.format == FORMAT_JPEG:
+            # Flatten the transparency on the background color
+            flat = Image.new('RGB', image.size, outputFormat.background)
+            flat.paste(image, (0, 0), image if image.mode == 'RGBA' else None)
+            flat.save(buffer, 'JPEG', quality=outputFormat.quality)
+        elif outputFormat.format == FORMAT_WEBP:
+            image.save(buffer, 'WEBP', lossless=outputFormat.lossless, quality=outputFormat.quality)
+        else:
+            image.save(buffer, 'PNG', compress_level=outputFormat.compressLevel, optimize=outputFormat.optimize)
+    with tracing.span(tracing.SPAN_WRITE, bytes=buffer.tell()):
+        tmpPath = tempPath(fname)
+        try:
+            with open(tmpPath, 'wb') as fp:
+                fp.write(buffer.getbuffer())
+            os.replace(tmpPath, fname)
+        except OSError:
+            removeLink(tmpPath)
+            raise
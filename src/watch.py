@@ -0,0 +1,107 @@
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+from app import App
+import batch
+
+# Seconds between two looks at the watched files
+WATCH_INTERVAL = 1.0
+# Seconds the size and modification time of a saved file must stay the same before it's
+# exported, large documents take a while to be written
+WATCH_SETTLE = 2.0
+
+class PSDWatcher:
+    """
+    Polls PSD files, folders or glob patterns (see batch.expandInputs) for saves. A saved
+    file is reported once it hasn't changed for settle seconds, so a file still being written
+    is left alone. Files that show up in the folders or match the patterns later are reported too.
+    """
+    def __init__(self, inputs:List[str], settle:float = WATCH_SETTLE):
+        self.inputs:List[str] = inputs
+        self.settle:float = settle
+        self.known:Dict[str, Tuple[int, int]] = {} # Size and modification time of the last handled version
+        self.pending:Dict[str, Tuple[Tuple[int, int], float]] = {} # Last seen size and modification time, and since when
+
+    def files(self) -> List[str]:
+        return batch.expandInputs(self.inputs)
+
+    def _stat(self, fpath:str) -> Tuple[int, int]:
+        st = os.stat(fpath)
+        return st.st_size, st.st_mtime_ns
+
+    def markCurrent(self):
+        """
+        Take the files as they are now as handled, e.g. before exporting them all
+        """
+        self.known = {}
+        self.pending = {}
+        for f in self.files():
+            try:
+                self.known[f] = self._stat(f)
+            except OSError:
+                pass
+
+    def poll(self, now:float = None) -> List[str]:
+        """
+        Returns the files saved since they were last handled, once they're settled
+        """
+        now = time.time() if now is None else now
+        changed = []
+        current = set()
+        for f in self.files():
+            try:
+                st = self._stat(f)
+            except OSError:
+                # Deleted or being replaced by the application saving it
+                continue
+            current.add(f)
+            if self.known.get(f) == st:
+                self.pending.pop(f, None)
+            elif f in self.pending and self.pending[f][0] == st:
+                if now - self.pending[f][1] >= self.settle:
+                    self.known[f] = st
+                    del self.pending[f]
+                    changed.append(f)
+            else:
+                self.pending[f] = (st, now)
+        for f in list(self.known.keys()):
+            if f not in current:
+                del self.known[f]
+        return changed
+
+
+def runWatch(app:App, watcher:PSDWatcher, baseOutDir:str, batchMode:bool, onEvent:Callable[[Dict], None] = None,
+        isStopped:Callable[[], bool] = None, interval:float = WATCH_INTERVAL):
+    """
+    Export the variations of the app config for every file the watcher reports, until
+    isStopped returns True. The exports are always incremental: only the images whose
+    visible layers changed since the last export (or that show other layers, e.g. after
+    a rename changed what the patterns match) are rendered again. The files are read whole,
+    they're not mapped while waiting for the next save (see MappedPSDFile). In batch mode every file
+    goes to its own subfolder like in batch.runBatch, otherwise straight into the output folder.
+    onEvent gets a changed event (file) and then the events of batch.runBatch.
+    """
+    config = app.configDict()
+    config['export']['incremental'] = True
+    config['export']['lazyLoad'] = False
+    def emit(event:Dict):
+        if onEvent is not None:
+            onEvent(event)
+    while isStopped is None or not isStopped():
+        changed = watcher.poll()
+        if len(changed) > 0:
+            if batchMode:
+                outDirs = {f.psdPath: f.outDir for f in batch.planBatch(watcher.files(), baseOutDir)}
+            else:
+                outDirs = {f: baseOutDir for f in changed}
+            for f in changed:
+                emit({'event': 'changed', 'file': f})
+                try:
+                    result = batch.exportBatchFile(config, f, outDirs[f], app.exportSettings.jobs, False, emit)
+                except Exception as e:
+                    # Most likely saved again while it was read, the next save is picked up
+                    emit({'event': 'failed', 'file': f, 'message': str(e)})
+                    continue
+                emit(dict(result, event='finished', file=f))
+        time.sleep(interval)